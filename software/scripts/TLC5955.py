@@ -1,9 +1,16 @@
-
-
 #from pyserial at_protocol example
+import os
+import math
+import json
+import select
+import asyncio
 import serial
 import serial.threaded
+import threading
+import time
 import numpy as np
+from collections import deque
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError, CancelledError as FutureCancelledError
 
 try:
     import queue
@@ -13,16 +20,150 @@ except ImportError:
 class SCPIException(Exception):
     pass
 
-class SCPIPacketizer(serial.threaded.Packetizer):
+class SCPICommandError(SCPIException):
+    """the panel reported an error for an acknowledged message"""
+    pass
+
+class RingBuffer:
+    """preallocated byte ring buffer, addressed by absolute stream position"""
+    def __init__(self, capacity=4096):
+        size = 1 << (max(capacity,1)-1).bit_length() #round up to a power of 2
+        self._buf = bytearray(size)
+        self._mask = size - 1
+        self.head = 0 #position of the oldest byte
+        self.tail = 0 #position one past the newest byte
+
+    def __len__(self):
+        return self.tail - self.head
+
+    def clear(self):
+        self.head = self.tail = 0
+
+    def write(self, data):
+        """append data, growing the buffer only if it would overflow"""
+        n = len(data)
+        if len(self) + n > len(self._buf):
+            self._resize(len(self) + n)
+        size = len(self._buf)
+        i = self.tail & self._mask
+        k = min(n, size - i)
+        data = memoryview(data)
+        self._buf[i:i+k] = data[:k]
+        if k < n: #wrap around
+            self._buf[:n-k] = data[k:]
+        self.tail += n
+
+    def _resize(self, n):
+        data = self.read(self.head, self.tail)
+        size = 1 << (n-1).bit_length()
+        self._buf = bytearray(size)
+        self._mask = size - 1
+        self.tail = self.head
+        self.write(data)
+
+    def __getitem__(self, pos):
+        """byte at absolute position pos"""
+        return self._buf[pos & self._mask]
+
+    def find(self, sub, start, end):
+        """absolute position of the byte sub within [start, end), or -1"""
+        if start >= end: return -1
+        size = len(self._buf)
+        i = start & self._mask
+        j = i + (end - start)
+        if j <= size:
+            k = self._buf.find(sub, i, j)
+            return -1 if k == -1 else start + (k - i)
+        k = self._buf.find(sub, i, size)
+        if k != -1: return start + (k - i)
+        k = self._buf.find(sub, 0, j - size)
+        return -1 if k == -1 else start + (size - i) + k
+
+    def read(self, start, end):
+        """copy of the bytes within [start, end)"""
+        size = len(self._buf)
+        i = start & self._mask
+        j = i + (end - start)
+        if j <= size:
+            return bytes(self._buf[i:j])
+        return bytes(self._buf[i:size]) + bytes(self._buf[:j-size])
+
+    def consume(self, end):
+        """discard everything before end"""
+        self.head = end
+
+class SCPIPacketizer(serial.threaded.Protocol):
+    """splits the serial stream into CRLF terminated packets
+    
+    IEEE 488.2 arbitrary blocks (#<d><n><data>) and quoted strings are skipped
+    over as they arrive, so a terminator inside block data does not split the packet.
+    """
     TERMINATOR = b'\r\n'
+    stats = None #SCPIStats, when enabled
 
-    def __init__(self, response_queue: queue.Queue):
+    def __init__(self, response_queue: queue.Queue, buffer_size=4096):
         super(SCPIPacketizer, self).__init__()
         self._response_queue = response_queue
+        self._buffer = RingBuffer(buffer_size)
+        self._scan = 0 #next stream position to examine
+        self.transport = None
     
     @staticmethod
     def factory(response_queue: queue.Queue):
         return lambda: SCPIPacketizer(response_queue)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._buffer.clear()
+        self._scan = 0
+        #no more responses will come, so fail the commands waiting for them (see SCPIPending)
+        if hasattr(self._response_queue, 'fail'):
+            self._response_queue.fail(SCPIException(f'connection lost: {exc}'))
+        super(SCPIPacketizer, self).connection_lost(exc)
+
+    def data_received(self, data):
+        if self.stats is not None:
+            self.stats.received(len(data))
+        self._buffer.write(data)
+        self._frame()
+
+    def _frame(self):
+        """emit every complete packet in the buffer"""
+        buf = self._buffer
+        while self._scan < buf.tail:
+            pos = self._scan
+            #only look for block headers and strings up to the next line feed
+            lf = buf.find(0x0a, pos, buf.tail)
+            end = buf.tail if lf == -1 else lf
+            h = buf.find(0x23, pos, end) # '#'
+            q = buf.find(0x22, pos, end) # '"'
+            if q != -1 and (h == -1 or q < h):
+                k = buf.find(0x22, q+1, buf.tail)
+                if k == -1: return #wait for the closing quote
+                self._scan = k+1
+            elif h != -1:
+                if h+1 >= buf.tail: return #wait for the digit count
+                d = buf[h+1] - 0x30
+                if not 1 <= d <= 9:
+                    self._scan = h+1 #not a block: #h, #q, #b numbers or #0
+                    continue
+                if h+2+d > buf.tail: return #wait for the length
+                n = buf.read(h+2, h+2+d)
+                if not n.isdigit():
+                    self._scan = h+1 #malformed, leave it to _parse_scpi
+                    continue
+                self._scan = h+2+d+int(n) #skip the data without searching it
+            elif lf != -1:
+                self._scan = lf+1
+                if lf > buf.head and buf[lf-1] == 0x0d:
+                    packet = buf.read(buf.head, lf-1)
+                    buf.consume(lf+1)
+                    self.handle_packet(packet)
+            else:
+                self._scan = buf.tail
         
     def _parse_scpi(self, packet : bytes):
         if len(packet) == 0: return []
@@ -93,16 +234,352 @@ class SCPIPacketizer(serial.threaded.Packetizer):
                 responses.append(x)
         return responses
     
+    @staticmethod
+    def _block_end(message: bytes):
+        """index just past the last arbitrary block in message, 0 if there is none"""
+        end = i = 0
+        n = len(message)
+        while i < n:
+            c = message[i]
+            if c == 0x22: #quoted string
+                j = message.find(b'"', i+1)
+                i = n if j == -1 else j+1
+            elif c == 0x23 and i+1 < n and 0x31 <= message[i+1] <= 0x39: #arbitrary block
+                d = message[i+1] - 0x30
+                try:
+                    i += 2 + d + int(message[i+2:i+2+d])
+                    end = min(i, n)
+                except ValueError:
+                    i += 1
+            else:
+                i += 1
+        return end
+
+    @staticmethod
+    def _split_units(message: bytes, sep=b';'):
+        """split a message on sep, skipping over arbitrary blocks and quoted strings"""
+        units = []
+        start = i = 0
+        n = len(message)
+        while i < n:
+            c = message[i]
+            if c == 0x22: #quoted string
+                j = message.find(b'"', i+1)
+                i = n if j == -1 else j+1
+            elif c == 0x23 and i+1 < n and 0x31 <= message[i+1] <= 0x39: #arbitrary block
+                d = message[i+1] - 0x30
+                try:
+                    i += 2 + d + int(message[i+2:i+2+d])
+                except ValueError:
+                    i += 1
+            elif c == sep[0]:
+                units.append(message[start:i])
+                start = i = i+1
+            else:
+                i += 1
+        units.append(message[start:])
+        return units
+
+    def _parse_message(self, packet: bytes):
+        """parse a response. A compound (;-separated) response gives a list of responses"""
+        if b';' in packet:
+            units = self._split_units(packet)
+            if len(units) > 1:
+                return [self._parse_scpi(u) for u in units]
+        return self._parse_scpi(packet)
+
     def handle_packet(self, packet: bytes):
-        response = self._parse_scpi(packet)
+        stats = self.stats
+        if stats is None:
+            response = self._parse_message(packet)
+        else:
+            t = time.perf_counter()
+            response = self._parse_message(packet)
+            stats.parsed(len(packet), time.perf_counter() - t)
         self._response_queue.put(response)
+
+def _resolve(future, result=None, exception=None):
+    """set the outcome of a future unless it is already done (eg. cancelled by its owner)"""
+    if future.done(): return
+    try:
+        if exception is None:
+            future.set_result(result)
+        else:
+            future.set_exception(exception)
+    except Exception:
+        pass #lost a race with cancel()
+
+def _check_ack(scpi, future, checked):
+    """resolve checked from future, the reply to a message ending in SCPIProtocol.ACK"""
+    if future.cancelled():
+        checked.cancel()
+    elif future.exception() is not None:
+        _resolve(checked, exception=future.exception())
+    else:
+        response = future.result()
+        failed, scpi.error_count = SCPIProtocol.ack_status(response, scpi.error_count)
+        if failed:
+            _resolve(checked, exception=SCPICommandError(f'SCPI command failed: {response}'))
+        else:
+            _resolve(checked, response)
+
+class SCPIPending:
+    """matches responses, in order, to the futures of the commands awaiting them
+    
+    Has the same put() as queue.Queue so that it can be handed to SCPIPacketizer.
+    Responses that nothing is waiting for are passed on to the unsolicited queue.
+    """
+    #resync marker. The firmware doesn't register *OPC?, so use a constant query,
+    # doubled up so that its response can't be mistaken for a stale one
+    RESYNC = b':disp:geom?;:disp:geom?'
+    RESYNC_RESPONSE = [[8,12,5],[8,12,5]]
+
+    def __init__(self, unsolicited: queue.Queue, future_factory=Future):
+        self.unsolicited = unsolicited
+        self._new_future = future_factory
+        self._pending = deque() #(future, is_marker)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def expect(self):
+        """return a future for the next response"""
+        f = self._new_future()
+        with self._lock:
+            self._pending.append((f, False))
+        return f
+
+    def resync(self):
+        """cancel every outstanding future and expect the RESYNC response instead
         
+        Until the marker arrives, every response is discarded as stale.
+        """
+        marker = self._new_future()
+        with self._lock:
+            stale = [f for f, m in self._pending if not m]
+            self._pending = deque((f, m) for f, m in self._pending if m)
+            self._pending.append((marker, True))
+        for f in stale:
+            f.cancel()
+        return marker
+
+    def fail(self, exception):
+        """fail every outstanding future, eg. when the connection is lost"""
+        with self._lock:
+            pending, self._pending = self._pending, deque()
+        for f, m in pending:
+            _resolve(f, exception=exception)
+
+    def put(self, response):
+        with self._lock:
+            if not self._pending:
+                f = None
+            else:
+                f, marker = self._pending[0]
+                if marker and response != self.RESYNC_RESPONSE:
+                    return #stale
+                self._pending.popleft()
+        if f is None:
+            self.unsolicited.put_nowait(response)
+        else:
+            _resolve(f, response)
+
+def _scpi_headers(pattern: str):
+    """every spelling of a header pattern like 'DISPlay:SPIFrequency', upper case"""
+    headers = [b'']
+    for part in pattern.split(':'):
+        short = ''.join(c for c in part if not c.islower())
+        forms = {bytes(short, 'utf-8'), bytes(part.upper(), 'utf-8')}
+        headers = [(h + b':' if h else h) + f for h in headers for f in forms]
+    return set(headers)
+
+class Histogram:
+    """log2 histogram of durations: bin k counts durations in [2**k, 2**(k+1)) microseconds"""
+    BINS = 24 #up to ~16 s
+
+    def __init__(self):
+        self.counts = [0]*self.BINS
+        self.count = 0
+        self.total = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def add(self, seconds):
+        k = math.frexp(seconds*1e6)[1] - 1
+        self.counts[min(max(k, 0), self.BINS-1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds < self.min: self.min = seconds
+        if seconds > self.max: self.max = seconds
+
+    def percentile(self, q):
+        """upper edge of the bin holding the q'th percentile, in seconds"""
+        if not self.count: return None
+        target = q/100*self.count
+        n = 0
+        for k, c in enumerate(self.counts):
+            n += c
+            if n >= target:
+                return min(2.0**(k+1)*1e-6, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean': self.total/self.count if self.count else None,
+                'min': self.min if self.count else None,
+                'max': self.max if self.count else None,
+                'p50': self.percentile(50),
+                'p99': self.percentile(99),
+                'bins_us': [2**k for k in range(self.BINS)],
+                'counts': list(self.counts)}
+
+class SCPIStats:
+    """link statistics gathered by SCPIProtocol.enable_stats()
+    
+    Per command verb (the first header of the message, eg. 'disp:pwm:all'): the
+    number sent, bytes sent and received, and a histogram of round trip times from
+    writing the command to its response being parsed. For the whole link: bytes
+    sent and received, the time spent parsing responses and the number of commands
+    awaiting responses, sampled as each command is sent.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.verbs = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.packets = 0
+            self.parse = Histogram()
+            self.max_depth = 0
+            self._depth_total = 0
+            self._depth_count = 0
+            self.started = time.monotonic()
+
+    @staticmethod
+    def verb(command):
+        """the first header of a command, normalized"""
+        head = bytes(command[:64]).split(b';', 1)[0].split(None, 1)
+        return str(head[0].lstrip(b':').lower(), 'ascii', 'replace') if head else ''
+
+    def _verb_stats(self, verb):
+        v = self.verbs.get(verb)
+        if v is None:
+            v = self.verbs[verb] = {'sent': 0, 'bytes_sent': 0, 'bytes_received': 0, 'discarded': 0, 'rtt': Histogram()}
+        return v
+
+    def sent(self, command, nbytes, future=None, depth=0):
+        """record a command of nbytes, and its round trip time if future is given"""
+        verb = self.verb(command)
+        with self._lock:
+            v = self._verb_stats(verb)
+            v['sent'] += 1
+            v['bytes_sent'] += nbytes
+            self.bytes_sent += nbytes
+            self._depth_total += depth
+            self._depth_count += 1
+            if depth > self.max_depth: self.max_depth = depth
+        if future is not None:
+            t0 = time.perf_counter()
+            future.add_done_callback(lambda f: self._done(verb, t0, f))
+
+    def _done(self, verb, t0, future):
+        rtt = time.perf_counter() - t0
+        #responses are resolved on the reader thread, straight after parsed()
+        nbytes = getattr(self._local, 'packet', 0)
+        with self._lock:
+            v = self._verb_stats(verb)
+            if future.cancelled():
+                v['discarded'] += 1
+            else:
+                v['rtt'].add(rtt)
+                v['bytes_received'] += nbytes
+
+    def received(self, nbytes):
+        with self._lock:
+            self.bytes_received += nbytes
+
+    def parsed(self, nbytes, seconds):
+        self._local.packet = nbytes + len(SCPIPacketizer.TERMINATOR)
+        with self._lock:
+            self.packets += 1
+            self.parse.add(seconds)
+
+    def snapshot(self):
+        """the statistics so far, as a dict of plain values"""
+        with self._lock:
+            elapsed = time.monotonic() - self.started
+            return {'elapsed': elapsed,
+                    'bytes_sent': self.bytes_sent,
+                    'bytes_received': self.bytes_received,
+                    'send_rate': self.bytes_sent/elapsed if elapsed > 0 else None,
+                    'receive_rate': self.bytes_received/elapsed if elapsed > 0 else None,
+                    'packets': self.packets,
+                    'parse': self.parse.snapshot(),
+                    'queue_depth': {'max': self.max_depth,
+                                    'mean': self._depth_total/self._depth_count if self._depth_count else None},
+                    'verbs': {verb: dict(v, rtt=v['rtt'].snapshot()) for verb, v in self.verbs.items()}}
+
+    def dump(self, file, **kwargs):
+        """write snapshot() as JSON to a path or file object"""
+        if isinstance(file, (str, os.PathLike)):
+            with open(file, 'w') as f:
+                json.dump(self.snapshot(), f, **kwargs)
+        else:
+            json.dump(self.snapshot(), file, **kwargs)
 
 class SCPIProtocol:
+    """SCPI over a serial port
+    
+    command(..., wait_for_response=True) executes one command at a time. For
+    pipelining, submit() returns a Future instead of waiting, so that many commands
+    may be in flight at once, from any number of threads. Futures are matched to
+    responses in the order the commands were written. Echo must be off.
+    
+    enable_stats() turns on per-command latency and throughput statistics.
+    """
+    #the firmware's input buffer holds 1024 bytes, including the terminator and a null
+    MAX_MESSAGE = 1024 - len(SCPIPacketizer.TERMINATOR) - 1
+    #query to acknowledge the commands before it, in place of *OPC? which the firmware lacks
+    ACK = b':syst:err:coun?'
+
     def __init__(self, serial_instance):
         self.port = serial_instance
-        self.responses = queue.Queue()
-        self._read_thread = serial.threaded.ReaderThread(serial_instance, SCPIPacketizer.factory(self.responses))
+        self.responses = queue.Queue() #unsolicited responses
+        self.pending = SCPIPending(self.responses)
+        self._write_lock = threading.Lock()
+        self._block_headers = {} #(prefix, length) -> prefix and block header
+        self._staging = bytearray() #for coalescing writes when writev isn't available
+        self.stats = None
+        self.error_count = None #the panel's error count at the last checked acknowledgement
+        try:
+            self._fd = serial_instance.fileno() if hasattr(os, 'writev') else None
+        except (AttributeError, OSError):
+            self._fd = None
+        self._read_thread = serial.threaded.ReaderThread(serial_instance, self._packetizer)
+
+    def _packetizer(self):
+        packetizer = SCPIPacketizer(self.pending)
+        packetizer.stats = self.stats
+        return packetizer
+
+    def enable_stats(self, stats=None):
+        """start gathering link statistics, returns the SCPIStats"""
+        self.stats = SCPIStats() if stats is None else stats
+        if self._read_thread.protocol is not None:
+            self._read_thread.protocol.stats = self.stats
+        return self.stats
+
+    def disable_stats(self):
+        """stop gathering statistics, returns the SCPIStats gathered so far"""
+        stats, self.stats = self.stats, None
+        if self._read_thread.protocol is not None:
+            self._read_thread.protocol.stats = None
+        return stats
 
     def start(self):
         self._read_thread.start()
@@ -121,14 +598,242 @@ class SCPIProtocol:
         self._read_thread.__exit__(exc_type, exc_val, exc_tb)
 
     def command(self, command: bytes, wait_for_response=False, timeout=5):
+        """send a command, and wait for its response if wait_for_response is set
+        
+        Without waiting, a command that produces a response still gets a Future so that
+        the response can't be matched to a later command. That Future is returned,
+        or None if the command has no response.
+        """
+        if wait_for_response:
+            return self.result(self.submit(command, True), timeout)
+        f = self.submit(command)
+        return None if f.done() else f
+
+    #commands that produce a response without being queries, from the firmware's command table
+    RESPONDING_HEADERS = _scpi_headers('DISPlay:SPIFrequency') | _scpi_headers('*RST')
+
+    @staticmethod
+    def expects_response(command: bytes):
+        """True if any header in the (compound) command is a query or otherwise responds"""
+        for unit in SCPIPacketizer._split_units(command):
+            header = unit.strip().split(None, 1)
+            if header and (b'?' in header[0] or
+                           header[0].lstrip(b':').upper() in SCPIProtocol.RESPONDING_HEADERS):
+                return True
+        return False
+
+    def submit(self, command: bytes, response=None):
+        """send a command without waiting, returns a Future for its response
+        
+        response : True if the command produces a response.
+                   If None, it is found by expects_response().
+        If there is no response, the Future is already complete.
+        """
         if type(command) is str:
             command = bytes(command, 'utf-8')
-        self._read_thread.write(command)
-        self._read_thread.write(SCPIPacketizer.TERMINATOR)
-        if wait_for_response:
-            return self.response(timeout)
-        else:
-            return None
+        if response is None:
+            response = self.expects_response(command)
+        with self._write_lock:
+            if response:
+                f = self.pending.expect()
+            else:
+                f = Future()
+                f.set_result(None)
+            if self.stats is not None:
+                self.stats.sent(command, len(command) + len(SCPIPacketizer.TERMINATOR), f if response else None, len(self.pending))
+            self._write((command, SCPIPacketizer.TERMINATOR))
+        return f
+
+    def block_header(self, prefix: bytes, length):
+        """prefix followed by the header of a length byte arbitrary block, cached"""
+        key = (prefix, length)
+        header = self._block_headers.get(key)
+        if header is None:
+            n = str(length)
+            header = prefix + bytes(f'#{len(n)}{n}', 'utf-8')
+            self._block_headers[key] = header
+        return header
+
+    def write_block(self, prefix: bytes, data, suffix=b'', response=None):
+        """send prefix, data as an arbitrary block, and suffix as one command
+        
+        data : bytes-like or contiguous array, eg. TLC5955.pwm_code(img). It is written
+               straight from its own memory, together with the header, in one write.
+        response : as for submit(), guessed from prefix and suffix if None
+        returns a Future for the response
+        """
+        if type(prefix) is str:
+            prefix = bytes(prefix, 'utf-8')
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+        data = memoryview(data).cast('B')
+        if response is None:
+            response = self.expects_response(prefix + suffix)
+        header = self.block_header(prefix, len(data))
+        with self._write_lock:
+            if response:
+                f = self.pending.expect()
+            else:
+                f = Future()
+                f.set_result(None)
+            if self.stats is not None:
+                nbytes = len(header) + len(data) + len(suffix) + len(SCPIPacketizer.TERMINATOR)
+                self.stats.sent(header, nbytes, f if response else None, len(self.pending))
+            self._write((header, data, suffix + SCPIPacketizer.TERMINATOR))
+        return f
+
+    def _write(self, buffers):
+        """write several buffers with one system call, the caller holds _write_lock"""
+        if self._fd is None:
+            n = sum(len(b) for b in buffers)
+            if len(self._staging) < n:
+                self._staging = bytearray(n)
+            staging = memoryview(self._staging)
+            i = 0
+            for b in buffers:
+                staging[i:i+len(b)] = b
+                i += len(b)
+            self.port.write(staging[:n])
+            return
+        views = [memoryview(b) for b in buffers]
+        timeout = self.port.write_timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while views:
+            try:
+                n = os.writev(self._fd, views)
+            except BlockingIOError:
+                wait = None if deadline is None else deadline - time.monotonic()
+                if wait is not None and wait <= 0:
+                    raise serial.SerialTimeoutException('Write timeout') #as Serial.write
+                select.select([], [self._fd], [], wait)
+                continue
+            while views and n >= len(views[0]):
+                n -= len(views.pop(0))
+            if n:
+                views[0] = views[0][n:]
+
+    def resync(self):
+        """discard outstanding responses and resynchronise with a marker query
+        
+        Returns a Future that completes when the marker's response arrives.
+        """
+        with self._write_lock:
+            marker = self.pending.resync()
+            if self.stats is not None:
+                self.stats.sent(SCPIPending.RESYNC, len(SCPIPending.RESYNC) + len(SCPIPacketizer.TERMINATOR), marker, len(self.pending))
+            self._write((SCPIPending.RESYNC, SCPIPacketizer.TERMINATOR))
+        return marker
+
+    def result(self, future, timeout=5):
+        """wait for the response to a submitted command
+        
+        A timeout resynchronises the response stream and raises SCPIException.
+        """
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            self.resync()
+            raise SCPIException('SCPI response timeout')
+        except FutureCancelledError:
+            raise SCPIException('SCPI response discarded by resync')
+
+    def gather(self, futures, timeout=5):
+        """wait for the responses to several submitted commands"""
+        deadline = time.monotonic() + timeout
+        return [self.result(f, max(0, deadline - time.monotonic())) for f in futures]
+
+    @staticmethod
+    def ack_status(response, count=None):
+        """check the response to a message ending in ACK
+        
+        count : the panel's error count at the previous acknowledgement, if known
+        returns (failed, count). The message failed if any command in it reported
+        **ERROR** or the error count went up. The firmware only clears its error
+        queue when it is read, so the count is compared rather than tested for zero.
+        """
+        units = response if (response and isinstance(response[0], list)) else [response]
+        try:
+            new_count = int(units[-1][0])
+        except (TypeError, ValueError, IndexError):
+            return True, count #not an acknowledgement
+        failed = ['**ERROR**'] in units or (count is not None and new_count > count)
+        return failed, new_count
+
+    def checked(self, future):
+        """a Future for the response to a message ending in ACK, which raises
+        SCPICommandError if the panel reported an error (see ack_status)"""
+        checked = Future()
+        future.add_done_callback(lambda f: _check_ack(self, f, checked))
+        return checked
+
+    def _pack(self, commands):
+        """pack commands into as few compound messages as possible
+        
+        returns [(message, slots, n)] where slots[i] is True if the i'th command in
+        the message produces a response and n is the number of commands from the caller.
+        """
+        packed = []
+        units, slots, size = [], [], 0
+        def close():
+            n = len(units)
+            #the firmware only ends a compound response with a newline if the last
+            # command produced output, so finish with a query
+            if any(slots) and not slots[-1]:
+                units.append(self.ACK)
+                slots.append(True)
+            packed.append((b';'.join(units), slots, n))
+        for item in commands:
+            if isinstance(item, (tuple, list)):
+                cmd, resp = item
+            else:
+                cmd, resp = item, None
+            if type(cmd) is str:
+                cmd = bytes(cmd, 'utf-8')
+            #trim the text, but never the bytes of an arbitrary block
+            cmd = cmd.lstrip()
+            end = SCPIPacketizer._block_end(cmd)
+            cmd = cmd[:end] + cmd[end:].rstrip()
+            if resp is None:
+                resp = self.expects_response(cmd)
+            #without a leading colon, headers are relative to the previous command
+            if not cmd.startswith((b'*', b':')):
+                cmd = b':' + cmd
+            if units and size + 1 + len(cmd) + 1 + len(self.ACK) > self.MAX_MESSAGE:
+                close()
+                units, slots, size = [], [], 0
+            size += len(cmd) + (1 if units else 0)
+            units.append(cmd)
+            slots.append(bool(resp))
+        if units:
+            close()
+        return packed
+
+    @staticmethod
+    def _unpack(response, slots, n):
+        """split a compound response into one result per command, None if it has none"""
+        if response is None:
+            return [None]*n
+        #a single response is a flat list of values, a compound one is a list of lists
+        units = response if (response and isinstance(response[0], list)) else [response]
+        if len(units) != sum(slots) or ['**ERROR**'] in units:
+            raise SCPIException(f'SCPI batch failed: expected {sum(slots)} responses, got {units}')
+        units = iter(units)
+        return [next(units) if s else None for s in slots][:n]
+
+    def batch(self, commands, timeout=5):
+        """execute commands and queries in as few writes as possible
+        
+        commands : sequence of single commands, or (command, response) pairs where
+                   response is as for submit()
+        Commands are joined into ;-separated compound messages that fit the firmware's
+        input buffer. Returns the response to each command, or None if it has none.
+        """
+        packed = self._pack(commands)
+        futures = [self.submit(msg, any(slots)) for msg, slots, n in packed]
+        results = []
+        for (msg, slots, n), response in zip(packed, self.gather(futures, timeout)):
+            results.extend(self._unpack(response, slots, n))
+        return results
 
     def format_bytes(self, data: bytes):
         n = '{}'.format(len(data))
@@ -141,6 +846,454 @@ class SCPIProtocol:
         except queue.Empty:
             raise SCPIException('SCPI response timeout')
 
+    #sent after each streamed frame: show it, then acknowledge
+    STREAM_SUFFIX = b';:disp:refr;' + ACK
+
+    def stream(self, frames, fps=None, window=4, drop_late=True, tolerance=1e-3, timeout=5, uploader=None,
+               monitor=None, times=None, report=None):
+        """display a sequence of frames at a fixed rate, or on a schedule
+        
+        frames : iterable or array of (8,12,5) images. Floats are converted by
+                 TLC5955.pwm_code, integers are sent as PWM codes. A bytes item is a
+                 command, eg. b':disp on', which is scheduled and acknowledged like a frame.
+        fps : frame rate. Frame i is due at start + i/fps, so lateness doesn't accumulate.
+        window : maximum number of frames sent but not yet acknowledged by the panel.
+        drop_late : skip frames that are more than one frame period overdue (only with fps).
+        tolerance : frames sent more than this many seconds after they were due are late.
+        uploader : a FrameUploader, to send only the LEDs that changed when that is cheaper.
+        monitor : called with each frame's PWM codes once it is sent, eg. preview.Preview.show.
+                  It must return quickly, as the next frame waits for it.
+        times : when each frame is due, in seconds from the start, instead of i/fps.
+                With neither fps nor times, frames are sent as fast as the window allows.
+        report : the StreamReport to record into, eg. a subclass, instead of a new one
+        returns the StreamReport. Frames the panel reported errors for are listed in its failed.
+        """
+        if isinstance(frames, np.ndarray) and frames.dtype.kind == 'f':
+            frames = TLC5955.pwm_code(frames) #convert the whole stack at once
+        period = None if fps is None else 1.0/fps
+        if report is None:
+            report = StreamReport(fps, tolerance)
+        in_flight = deque()
+        start = time.monotonic()
+        def wait(f):
+            try:
+                self.result(f, timeout)
+            except SCPICommandError:
+                pass #recorded in report.failed
+        for i, frame in enumerate(frames):
+            while len(in_flight) >= window: #backpressure
+                wait(in_flight.popleft())
+            if times is not None:
+                due = start + times[i]
+            elif period is not None:
+                due = start + i*period
+            else: #as fast as possible, each frame is due as soon as the window lets it go
+                due = time.monotonic()
+            if drop_late and period is not None and time.monotonic() > due + period:
+                report.dropped.append(i)
+                continue
+            command = isinstance(frame, bytes)
+            if not command:
+                frame = np.asarray(frame)
+                if frame.dtype.kind == 'f':
+                    frame = TLC5955.pwm_code(frame)
+                frame = np.ascontiguousarray(frame, '<u2')
+            sleep_until(due)
+            if command:
+                f = self.checked(self.submit(frame + b';' + self.ACK, True))
+            elif uploader is None:
+                f = self.checked(self.write_block(b':disp:pwm:all ', frame, self.STREAM_SUFFIX, True))
+            else:
+                f = uploader.upload(frame, ack=True)
+            report._record(i, due, time.monotonic(), f)
+            in_flight.append(f)
+            if monitor is not None and not command:
+                monitor(frame)
+        while in_flight:
+            wait(in_flight.popleft())
+        return report
+
+def sleep_until(t, spin=2e-3):
+    """sleep until time.monotonic() >= t, spinning for the last few ms for precision"""
+    dt = t - time.monotonic()
+    if dt > spin:
+        time.sleep(dt - spin)
+    while time.monotonic() < t:
+        pass
+
+async def async_sleep_until(t, spin=2e-3):
+    """as sleep_until, but sleeping on the event loop"""
+    dt = t - time.monotonic()
+    if dt > spin:
+        await asyncio.sleep(dt - spin)
+    while time.monotonic() < t:
+        pass
+
+class StreamReport:
+    """frame timing from SCPIProtocol.stream(). Times are from time.monotonic(), in seconds
+    
+    index : index of each sent frame in the input sequence
+    due, sent, acked : when each sent frame was due, written, and acknowledged by the panel
+    dropped : indices of the frames that were skipped
+    failed : indices of the frames that the panel reported an error for
+    """
+    def __init__(self, fps, tolerance):
+        self.fps = fps
+        self.tolerance = tolerance
+        self._index, self._due, self._sent, self._acked = [], [], [], []
+        self.dropped = []
+        self.failed = []
+
+    def _record(self, i, due, sent, future):
+        k = len(self._acked)
+        self._index.append(i)
+        self._due.append(due)
+        self._sent.append(sent)
+        self._acked.append(np.nan)
+        def acked(f):
+            self._acked[k] = time.monotonic()
+            if not f.cancelled() and isinstance(f.exception(), SCPICommandError):
+                self.failed.append(i)
+        future.add_done_callback(acked)
+
+    @property
+    def index(self): return np.array(self._index, int)
+    @property
+    def due(self): return np.array(self._due)
+    @property
+    def sent(self): return np.array(self._sent)
+    @property
+    def acked(self): return np.array(self._acked)
+
+    @property
+    def lateness(self):
+        """seconds between when each frame was due and when it was sent"""
+        return self.sent - self.due
+
+    @property
+    def late(self):
+        """indices of the frames that were sent late"""
+        return self.index[self.lateness > self.tolerance]
+
+    @property
+    def latency(self):
+        """seconds between sending each frame and its acknowledgement"""
+        return self.acked - self.sent
+
+    @property
+    def achieved_fps(self):
+        """mean rate that frames were actually sent"""
+        sent = self._sent
+        if len(sent) < 2: return np.nan
+        return (len(sent)-1)/(sent[-1] - sent[0])
+
+    def __repr__(self):
+        n = len(self._index)
+        return (f'StreamReport({n} sent, {len(self.late)} late, {len(self.dropped)} dropped, {len(self.failed)} failed, '
+                f'{self.achieved_fps:.2f} of {self.fps} fps, max lateness {np.max(self.lateness, initial=0)*1e3:.2f} ms)')
+
+class FrameUploader:
+    """uploads frames, sending only the LEDs that changed when that is cheaper
+    
+    Keeps a shadow copy of the PWM codes last sent to the panel. Each frame is sent
+    either as compound DISP:PWM y,x,c,v commands for the LEDs that differ from the
+    shadow, or as one DISP:PWM:ALL block, whichever is fewer bytes, then DISP:REFR.
+    Call reset() if anything else changes the panel's PWM codes. An acknowledged
+    upload that the panel reports an error for also resets, and counts in failures.
+    """
+    FULL_PREFIX = b':disp:pwm:all '
+    SPARSE_PREFIX = b':disp:pwm '
+
+    def __init__(self, scpi, shape=(8,12,5)):
+        self.scpi = scpi
+        self.shape = shape
+        self.shadow = np.zeros(shape, np.uint16)
+        self._valid = False #is the shadow known to match the panel?
+        self.full_frames = 0
+        self.sparse_frames = 0
+        self.bytes_sent = 0
+        self.failures = 0
+
+    def reset(self):
+        """forget the panel's state, so that the next frame is sent in full"""
+        self._valid = False
+
+    @staticmethod
+    def _digits(x):
+        """number of decimal digits in each element of x"""
+        x = np.asarray(x)
+        return 1 + (x >= 10) + (x >= 100) + (x >= 1000) + (x >= 10000)
+
+    def upload(self, frame, refresh=True, ack=False):
+        """send a frame of PWM codes (or floats, converted by TLC5955.pwm_code)
+        
+        refresh : follow with DISP:REFR so that the panel shows the new frame
+        ack : follow with SCPIProtocol.ACK, so that the returned Future completes when the panel
+              is done. It raises SCPICommandError if the panel reported an error.
+        returns a Future for the last message sent
+        """
+        frame = np.asarray(frame)
+        if frame.dtype.kind == 'f':
+            frame = TLC5955.pwm_code(frame)
+        frame = np.ascontiguousarray(frame, '<u2').reshape(self.shape)
+        suffix = (b';:disp:refr' if refresh else b'') + (b';' + SCPIProtocol.ACK if ack else b'')
+        full_cost = len(self.scpi.block_header(self.FULL_PREFIX, frame.nbytes)) + frame.nbytes
+        if self._valid:
+            changed = np.nonzero(frame != self.shadow)
+            v = frame[changed]
+            #';:disp:pwm y,x,c,v' for each changed LED
+            sparse_cost = (len(self.SPARSE_PREFIX) + 4)*len(v) + np.sum(self._digits(changed[0]) + self._digits(changed[1]) + self._digits(changed[2]) + self._digits(v))
+        else:
+            sparse_cost = full_cost
+        if sparse_cost < full_cost:
+            commands = [self.SPARSE_PREFIX + b'%d,%d,%d,%d' % yxcv for yxcv in zip(*changed, v)]
+            commands.extend(suffix.split(b';')[1:])
+            f = Future()
+            f.set_result(None) #nothing to send
+            for msg, slots, n in self.scpi._pack(commands):
+                f = self.scpi.submit(msg, any(slots))
+                self.bytes_sent += len(msg)
+            self.sparse_frames += 1
+        else:
+            f = self.scpi.write_block(self.FULL_PREFIX, frame, suffix, ack)
+            self.bytes_sent += full_cost + len(suffix)
+            self.full_frames += 1
+        self.shadow[...] = frame
+        self._valid = True
+        if ack:
+            f = self.scpi.checked(f)
+            f.add_done_callback(self._acked)
+        return f
+
+    def _acked(self, f):
+        if not f.cancelled() and isinstance(f.exception(), SCPICommandError):
+            #some of the frame may not have reached the panel
+            self.failures += 1
+            self.reset()
+
+class AsyncSCPIProtocol:
+    """SCPI over a serial port, driven by an asyncio event loop
+    
+    The port's file descriptor is watched with loop.add_reader, so there is no reader
+    thread (POSIX only). Framing and parsing is done by SCPIPacketizer and responses
+    are matched to commands as in SCPIProtocol. Echo must be off.
+    Use within the event loop: async with AsyncSCPIProtocol(port) as scpi: ...
+    """
+    def __init__(self, serial_instance):
+        self.port = serial_instance
+        self.responses = asyncio.Queue() #unsolicited responses
+        self.pending = SCPIPending(self.responses, self._create_future)
+        self._packetizer = SCPIPacketizer(self.pending)
+        self._loop = None
+        self._fd = None
+        self._out = bytearray() #data waiting for the port to become writable
+        self._block_headers = {}
+        self._drained = asyncio.Event()
+        self._drained.set()
+        self.error_count = None
+
+    def _create_future(self):
+        return self._loop.create_future()
+
+    def start(self):
+        """start reading the port, must be called from the event loop"""
+        self._loop = asyncio.get_running_loop()
+        self._fd = self.port.fileno()
+        self._packetizer.connection_made(self)
+        self._loop.add_reader(self._fd, self._read_ready)
+
+    def stop(self):
+        """stop reading the port, but leave it open"""
+        if self._fd is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._fd = None
+
+    def close(self):
+        self.stop()
+        self.port.close()
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _read_ready(self):
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        if not data: #end of file
+            self._connection_lost(None)
+            return
+        try:
+            self._packetizer.data_received(data)
+        except Exception as e:
+            self._connection_lost(e)
+
+    def _connection_lost(self, exc):
+        self.stop()
+        self.pending.fail(SCPIException(f'connection lost: {exc}'))
+        self._packetizer.connection_lost(None)
+
+    def write(self, data: bytes):
+        """write without blocking, the remainder is sent when the port is writable"""
+        self._write((data,))
+
+    def _write(self, buffers):
+        """write several buffers with one system call, without blocking"""
+        if self._fd is None:
+            raise SCPIException('port is not open')
+        if not self._out:
+            views = [memoryview(b) for b in buffers]
+            try:
+                n = os.writev(self._fd, views)
+            except BlockingIOError:
+                n = 0
+            while views and n >= len(views[0]):
+                n -= len(views.pop(0))
+            if not views: #all written
+                return
+            views[0] = views[0][n:]
+            buffers = views
+            self._drained.clear()
+            self._loop.add_writer(self._fd, self._write_ready)
+        for b in buffers: #only copied if the port can't take it all now
+            self._out += b
+
+    def _write_ready(self):
+        try:
+            n = os.write(self._fd, self._out)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._connection_lost(e)
+            return
+        del self._out[:n]
+        if not self._out:
+            self._loop.remove_writer(self._fd)
+            self._drained.set()
+
+    async def drain(self):
+        """wait until everything written has been passed to the port"""
+        await self._drained.wait()
+
+    expects_response = staticmethod(SCPIProtocol.expects_response)
+    format_bytes = SCPIProtocol.format_bytes
+
+    def submit(self, command: bytes, response=None):
+        """send a command without waiting, returns an asyncio Future for its response
+        
+        response : as for SCPIProtocol.submit
+        """
+        if type(command) is str:
+            command = bytes(command, 'utf-8')
+        if response is None:
+            response = self.expects_response(command)
+        if response:
+            f = self.pending.expect()
+        else:
+            f = self._create_future()
+            f.set_result(None)
+        self._write((command, SCPIPacketizer.TERMINATOR))
+        return f
+
+    block_header = SCPIProtocol.block_header
+
+    def write_block(self, prefix: bytes, data, suffix=b'', response=None):
+        """send prefix, data as an arbitrary block, and suffix as one command
+        
+        see SCPIProtocol.write_block, returns an asyncio Future for the response
+        """
+        if type(prefix) is str:
+            prefix = bytes(prefix, 'utf-8')
+        if isinstance(data, np.ndarray):
+            data = np.ascontiguousarray(data)
+        data = memoryview(data).cast('B')
+        if response is None:
+            response = self.expects_response(prefix + suffix)
+        if response:
+            f = self.pending.expect()
+        else:
+            f = self._create_future()
+            f.set_result(None)
+        self._write((self.block_header(prefix, len(data)), data, suffix + SCPIPacketizer.TERMINATOR))
+        return f
+
+    def resync(self):
+        """discard outstanding responses and resynchronise with a marker query"""
+        marker = self.pending.resync()
+        self._write((SCPIPending.RESYNC, SCPIPacketizer.TERMINATOR))
+        return marker
+
+    async def result(self, future, timeout=5):
+        """wait for the response to a submitted command
+        
+        A timeout resynchronises the response stream and raises SCPIException.
+        Cancelling the caller leaves the future in place, so its response is still
+        consumed in order when it arrives.
+        """
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+        except asyncio.TimeoutError:
+            self.resync()
+            raise SCPIException('SCPI response timeout')
+        except asyncio.CancelledError:
+            if future.cancelled(): #by resync, rather than the caller being cancelled
+                raise SCPIException('SCPI response discarded by resync')
+            raise
+
+    async def command(self, command: bytes, wait_for_response=False, timeout=5):
+        """see SCPIProtocol.command, returns an asyncio Future when not waiting"""
+        if wait_for_response:
+            return await self.result(self.submit(command, True), timeout)
+        f = self.submit(command)
+        return None if f.done() else f
+
+    async def query(self, command: bytes, timeout=5):
+        return await self.result(self.submit(command, True), timeout)
+
+    async def gather(self, futures, timeout=5):
+        """wait for the responses to several submitted commands"""
+        deadline = time.monotonic() + timeout
+        return [await self.result(f, max(0, deadline - time.monotonic())) for f in futures]
+
+    ack_status = staticmethod(SCPIProtocol.ack_status)
+
+    def checked(self, future):
+        """see SCPIProtocol.checked, returns an asyncio Future"""
+        checked = self._create_future()
+        future.add_done_callback(lambda f: _check_ack(self, f, checked))
+        return checked
+
+    MAX_MESSAGE = SCPIProtocol.MAX_MESSAGE
+    ACK = SCPIProtocol.ACK
+    _pack = SCPIProtocol._pack
+    _unpack = staticmethod(SCPIProtocol._unpack)
+
+    async def batch(self, commands, timeout=5):
+        """execute commands and queries in as few writes as possible, see SCPIProtocol.batch"""
+        packed = self._pack(commands)
+        futures = [self.submit(msg, any(slots)) for msg, slots, n in packed]
+        results = []
+        for (msg, slots, n), response in zip(packed, await self.gather(futures, timeout)):
+            results.extend(self._unpack(response, slots, n))
+        return results
+
+    async def response(self, timeout=5):
+        try:
+            return await asyncio.wait_for(self.responses.get(), timeout)
+        except asyncio.TimeoutError:
+            raise SCPIException('SCPI response timeout')
+
+#current in mA of each max current code, from the TLC5955 datasheet
+MAXCURRENT_MA = np.array([3.2, 8, 11.2, 15.9, 19.1, 23.9, 27.1, 31.9])
+
 class TLC5955:
     DSPRPT=(1 << 0)
     TMGRST=(1 << 1)
@@ -170,8 +1323,7 @@ class TLC5955:
     @staticmethod
     def maxcurrent_code(Imax_mA):
         """picks the largest allowed current less than or equal to the given current"""
-        Imcs = [3.2,8,11.2,15.9,19.1,23.9,27.1,31.9]
-        for i,Imc in enumerate(Imcs):
+        for i,Imc in enumerate(MAXCURRENT_MA):
             if Imc > Imax_mA:
                 break
         if i > 0: return i-1
@@ -180,39 +1332,156 @@ class TLC5955:
     @staticmethod
     def maxcurrent_mA(Imax_code):
         """return the current in mA for a given maxcurrent code"""
-        Imcs = [3.2,8,11.2,15.9,19.1,23.9,27.1,31.9]
-        return Imcs[Imax_code]
+        return MAXCURRENT_MA[Imax_code]
     
+    #code = floor((x - offset)*mul/div) clipped to [0, top]
+    BRIGHTNESS_CODEC = (0.1, np.nextafter(128,0), 0.9, 127)
+    DOTCORRECT_CODEC = (0.262, np.nextafter(128,0), 0.738, 127)
+    PWM_CODEC = (0.0, np.nextafter(65536,0), 1.0, 65535)
+
     @staticmethod
-    def brightness_code(brightness):
+    def _encode(x, codec, out, scratch=None, nan_top=False):
+        """quantize x into the integer array out, through the float array scratch
+        
+        Allocates nothing if scratch is given. If nan_top, NaNs encode to the top code.
+        """
+        offset, mul, div, top = codec
+        if scratch is None:
+            scratch = np.empty(np.shape(x)) #so that scalars are quantized in place too
+        np.subtract(x, offset, out=scratch)
+        np.multiply(scratch, mul, out=scratch)
+        if div != 1.0:
+            np.divide(scratch, div, out=scratch)
+        np.floor(scratch, out=scratch)
+        if nan_top:
+            np.fmin(scratch, top, out=scratch) #fmin takes the number over the nan
+            np.maximum(scratch, 0, out=scratch)
+        else:
+            np.clip(scratch, 0, top, out=scratch)
+        np.copyto(out, scratch, casting='unsafe')
+        return out
+
+    @staticmethod
+    def _decode(code, lo, span, top, out=None):
+        """lo + span*code/top, clipped to [lo, lo+span], into the float array out"""
+        out = np.multiply(span, code, out=out)
+        np.divide(out, top, out=out)
+        np.add(lo, out, out=out)
+        return np.clip(out, lo, lo + span, out=out)
+
+    @staticmethod
+    def brightness_code(brightness, out=None):
         """brightness within 0.1 to 1"""
-        return np.clip(np.floor((brightness-0.1)*np.nextafter(128,0)/0.9),0,127).astype(np.uint8)
+        if out is None:
+            return np.clip(np.floor((brightness-0.1)*np.nextafter(128,0)/0.9),0,127).astype(np.uint8)
+        return TLC5955._encode(brightness, TLC5955.BRIGHTNESS_CODEC, out)
     
     @staticmethod
-    def brightness(brightness_code):
+    def brightness(brightness_code, out=None):
         """return brightness coefficient from a given brightness code"""
-        return np.clip(0.1 + 0.9*brightness_code/127, 0.1, 1.0)
+        if out is None:
+            return np.clip(0.1 + 0.9*brightness_code/127, 0.1, 1.0)
+        return TLC5955._decode(brightness_code, 0.1, 0.9, 127, out)
+    
+    @staticmethod
+    def dotcorrect_code(dc_img, out=None):
+        """dot correct within 0.262 to 1. dead pixels (nan) encode as 1.0, dc_img is left as it is"""
+        if out is None:
+            code = TLC5955._encode(dc_img, TLC5955.DOTCORRECT_CODEC, np.empty(np.shape(dc_img), np.uint8), nan_top=True)
+            return code[()] if code.ndim == 0 else code #a scalar for a scalar, as np.astype gives
+        return TLC5955._encode(dc_img, TLC5955.DOTCORRECT_CODEC, out, nan_top=True)
     
     @staticmethod
-    def dotcorrect_code(dc_img):
-        """dot correct within 0.262 to 1."""
+    def dotcorrect_encode(dc_img, out=None):
+        """dot correct codes and dead pixel mask, for one (8,12,5) image or a stack of them
+        
+        returns codes, dead where dead[...,y,x] is True if any channel of the pixel is nan
+        """
         dc_img = np.asarray(dc_img)
-        dc_img[np.isnan(dc_img)] = 1.0 #dead pixels have a dc of nan
-        return np.clip(np.floor((dc_img - 0.262)*np.nextafter(128,0)/0.738),0,127).astype(np.uint8)
+        dead = np.isnan(dc_img).any(axis=-1)
+        return TLC5955.dotcorrect_code(dc_img, out), dead
     
     @staticmethod
-    def dotcorrect_img(dc_code):
+    def dotcorrect_img(dc_code, out=None):
         """dot correct coefficient given a code."""
         dc_code = np.asarray(dc_code)
-        return np.clip(0.262 + 0.738*dc_code/127,0.262,1.0)
+        if out is None:
+            return np.clip(0.262 + 0.738*dc_code/127,0.262,1.0)
+        return TLC5955._decode(dc_code, 0.262, 0.738, 127, out)
     
     @staticmethod
-    def pwm_code(img):
+    def pwm_code(img, out=None):
         """pwm values from 0.0 to 1.0"""
-        return np.clip(np.floor(np.nextafter(65536,0)*img),0,65535).astype(np.uint16)
+        if out is None:
+            return np.clip(np.floor(np.nextafter(65536,0)*img),0,65535).astype(np.uint16)
+        return TLC5955._encode(img, TLC5955.PWM_CODEC, out)
     
     @staticmethod
-    def pwm_img(pwm_code):
+    def pwm_img(pwm_code, out=None):
         """pwm ratio from a given code"""
-        return np.clip(pwm_code/65535,0.0,1.0)
-    
\ No newline at end of file
+        if out is None:
+            return np.clip(pwm_code/65535,0.0,1.0)
+        np.divide(pwm_code, 65535, out=out)
+        return np.clip(out, 0.0, 1.0, out=out)
+
+class TLC5955Encoder:
+    """TLC5955 codecs that reuse their buffers
+    
+    Each method takes an optional out array to write the result into. Without one,
+    the encoder returns a buffer of its own for that shape, which is overwritten by
+    the next call with the same shape. Once each shape has been seen, encoding and
+    decoding allocate nothing, which matters when streaming.
+    """
+    def __init__(self):
+        self._scratch = {} #shape -> float64 array
+        self._outputs = {} #(name, shape) -> array
+
+    def scratch(self, shape):
+        """a float64 work array of the given shape"""
+        buf = self._scratch.get(shape)
+        if buf is None:
+            buf = self._scratch[shape] = np.empty(shape, np.float64)
+        return buf
+
+    def _out(self, name, shape, dtype, out):
+        if out is not None: return out
+        buf = self._outputs.get((name, shape))
+        if buf is None:
+            buf = self._outputs[(name, shape)] = np.empty(shape, dtype)
+        return buf
+
+    def _encode(self, name, x, codec, dtype, out, nan_top=False):
+        shape = np.shape(x)
+        out = self._out(name, shape, dtype, out)
+        return TLC5955._encode(x, codec, out, self.scratch(shape), nan_top)
+
+    def pwm_code(self, img, out=None):
+        """as TLC5955.pwm_code"""
+        return self._encode('pwm', img, TLC5955.PWM_CODEC, np.uint16, out)
+
+    def dotcorrect_code(self, dc_img, out=None):
+        """as TLC5955.dotcorrect_code"""
+        return self._encode('dotcorrect', dc_img, TLC5955.DOTCORRECT_CODEC, np.uint8, out, nan_top=True)
+
+    def dotcorrect_encode(self, dc_img, out=None, dead=None):
+        """as TLC5955.dotcorrect_encode"""
+        shape = np.shape(dc_img)
+        isnan = np.isnan(dc_img, out=self._out('isnan', shape, bool, None))
+        dead = np.any(isnan, axis=-1, out=self._out('dead', shape[:-1], bool, dead))
+        return self.dotcorrect_code(dc_img, out), dead
+
+    def brightness_code(self, brightness, out=None):
+        """as TLC5955.brightness_code"""
+        return self._encode('brightness', brightness, TLC5955.BRIGHTNESS_CODEC, np.uint8, out)
+
+    def pwm_img(self, pwm_code, out=None):
+        """as TLC5955.pwm_img"""
+        return TLC5955.pwm_img(pwm_code, self._out('pwm_img', np.shape(pwm_code), np.float64, out))
+
+    def dotcorrect_img(self, dc_code, out=None):
+        """as TLC5955.dotcorrect_img"""
+        return TLC5955.dotcorrect_img(dc_code, self._out('dotcorrect_img', np.shape(dc_code), np.float64, out))
+
+    def brightness(self, brightness_code, out=None):
+        """as TLC5955.brightness"""
+        return TLC5955.brightness(brightness_code, self._out('brightness', np.shape(brightness_code), np.float64, out))
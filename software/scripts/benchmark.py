@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the host side of the panel link.
+
+Times response parsing, command and frame encoding, and end-to-end frame rate
+and query round trip time against an emulated panel (emulator.PtyPanel, POSIX
+only). Inputs are generated from a fixed seed so that runs are comparable.
+
+    python benchmark.py          run, and compare against the saved baseline
+    python benchmark.py --save   run, and save the results as the new baseline
+
+Each result is the best (least disturbed) of several repeats. A result slower
+than the baseline by more than --tolerance is flagged as a regression and the
+exit status is 1. Baselines are only meaningful on the machine that made them.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+from serial import Serial, serial_for_url
+from TLC5955 import SCPIPacketizer, SCPIProtocol, TLC5955, FrameUploader
+from payload_cache import PayloadCache
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+
+def best_time(fn, number, repeat=5):
+    """best per-call time of fn over repeat runs of number calls"""
+    best = float('inf')
+    for r in range(repeat):
+        t = time.perf_counter()
+        for i in range(number):
+            fn()
+        best = min(best, (time.perf_counter() - t)/number)
+    return best
+
+def responses(rng):
+    """realistic response packets, as the firmware formats them"""
+    ints = b','.join(b'%d' % v for v in rng.integers(0, 128, 480))
+    hexs = b','.join(b'#H%X' % v for v in rng.integers(0, 65536, 480))
+    pwm = rng.integers(0, 256, 960, dtype=np.uint8).tobytes()
+    dc = rng.integers(0, 128, 480, dtype=np.uint8).tobytes()
+    return {
+        'idn': b'"Samuel Powell",UVTV,4,2020-11-02',
+        'ints_480': ints,
+        'hex_480': hexs,
+        'block_960': b'#3960' + pwm,
+        'config': b'4;3000000;9;1,1,0,1;48,65,56,56;#3480' + dc + b';8,12,5',
+    }
+
+def parse_benchmarks(rng, number):
+    packetizer = SCPIPacketizer(None)
+    results = {}
+    for name, packet in responses(rng).items():
+        results[f'parse {name}'] = best_time(lambda: packetizer._parse_message(packet), number)
+    #framing: a block response arriving in USB sized chunks
+    stream = b'#3960' + rng.integers(0, 256, 960, dtype=np.uint8).tobytes() + SCPIPacketizer.TERMINATOR
+    chunks = [stream[i:i+64] for i in range(0, len(stream), 64)]
+    sink = SCPIPacketizer(type('sink', (), {'put': staticmethod(lambda r: None)})())
+    def frame():
+        for c in chunks:
+            sink.data_received(c)
+    results['frame block_960'] = best_time(frame, number)
+    return results
+
+def encode_benchmarks(rng, number):
+    img = rng.random((8,12,5))
+    stack = rng.random((100,8,12,5))
+    codes = TLC5955.pwm_code(img)
+    data = codes.tobytes()
+    scpi = SCPIProtocol(serial_for_url('loop://')) #not started, only for its encoding helpers
+    commands = [b'disp:mode 9', b'disp:maxc 1,1,0,1', b'disp:bri 48,65,56,56', b'disp:geom?']*8
+    cache = PayloadCache()
+    cache.message(img)
+    return {
+        'format_bytes 960': best_time(lambda: scpi.format_bytes(data), number),
+        'block_header 960': best_time(lambda: scpi.block_header(b'disp:pwm:all ', len(data)), number),
+        'pwm_code frame': best_time(lambda: TLC5955.pwm_code(img), number),
+        'pwm_code stack/frame': best_time(lambda: TLC5955.pwm_code(stack), max(1, number//100))/len(stack),
+        'dotcorrect_code frame': best_time(lambda: TLC5955.dotcorrect_code(img), number),
+        'pack 32 commands': best_time(lambda: scpi._pack(commands), max(1, number//10)),
+        'payload cache hit': best_time(lambda: cache.message(img), number),
+    }
+
+def link_benchmarks(rng, frames, queries):
+    """end to end over an emulated panel: times are per frame or per query"""
+    from emulator import PtyPanel
+    stack = TLC5955.pwm_code(rng.random((frames,8,12,5)))
+    results = {}
+    with PtyPanel() as panel, Serial(panel.port) as port, SCPIProtocol(port) as scpi:
+        scpi.command(b'syst:comm:echo off')
+        time.sleep(0.1)
+        scpi.resync().result(5) #discard the echo
+        rtt = []
+        for i in range(queries):
+            t = time.perf_counter()
+            scpi.command(b'*IDN?', True)
+            rtt.append(time.perf_counter() - t)
+        results['query rtt'] = float(np.median(rtt))
+        t = time.perf_counter()
+        scpi.gather([scpi.submit(b'disp:geom?') for i in range(queries)])
+        results['pipelined query'] = (time.perf_counter() - t)/queries
+        for name, uploader in (('full', None), ('sparse', FrameUploader(scpi))):
+            report = scpi.stream(stack, fps=1e4, window=8, drop_late=False, uploader=uploader)
+            results[f'stream {name} frame'] = 1/report.achieved_fps
+    return results
+
+def run(args):
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    results.update(parse_benchmarks(rng, args.number))
+    results.update(encode_benchmarks(rng, args.number))
+    if not args.no_link:
+        results.update(link_benchmarks(rng, args.frames, args.queries))
+    return results
+
+def compare(results, baseline, tolerance):
+    """print results against baseline, returns the names of regressions"""
+    regressions = []
+    width = max(len(name) for name in results)
+    for name, t in results.items():
+        line = f'{name:{width}}  {t*1e6:10.2f} us'
+        if name in baseline:
+            ratio = t/baseline[name]
+            line += f'  {ratio:6.2f}x baseline'
+            if ratio > 1 + tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--baseline', default=BASELINE, help='baseline results file (JSON)')
+    parser.add_argument('--save', action='store_true', help='save the results as the baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown, as a fraction of the baseline')
+    parser.add_argument('--seed', type=int, default=2020)
+    parser.add_argument('--number', type=int, default=1000, help='calls per repeat of the micro benchmarks')
+    parser.add_argument('--frames', type=int, default=200, help='frames streamed to the emulator')
+    parser.add_argument('--queries', type=int, default=200, help='queries sent to the emulator')
+    parser.add_argument('--no-link', action='store_true', help='skip the end-to-end benchmarks')
+    args = parser.parse_args()
+
+    results = run(args)
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    regressions = compare(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.baseline, 'w') as f:
+            json.dump({'python': sys.version, 'numpy': np.__version__, 'results': results}, f, indent=1)
+        print(f'saved baseline to {args.baseline}')
+    elif regressions:
+        print(f'{len(regressions)} regression(s) beyond {args.tolerance:.0%}')
+        sys.exit(1)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+Photoreceptor catches to panel PWM, from measured spectra.
+
+The catch of receptor i from a pixel showing pwm fractions p (R,G,B,V,UV) is
+
+    q_i = sum_c M[i,c] * gain_c * p_c
+
+where M[i,c] is the catch from channel c at full PWM with the settings the
+spectra were measured at, and gain_c scales those to the current max current
+and brightness settings (TLC5955 codec tables). ColorEngine precomputes the
+mixing matrix and its (pseudo) inverse once per setting, and solves whole
+stacks of images with one matrix product.
+
+With fewer receptors than channels many pwm mixtures give the same catches,
+and the inverse's minimum norm solution can be negative even when another
+mixture would reach the target. For those pixels solve() searches the faces
+of the [0,1] box (each channel off, on, or free) for the minimum norm mixture
+within it, and a target is only out of gamut when there is none.
+"""
+
+import itertools
+import numpy as np
+from collections import namedtuple
+from TLC5955 import TLC5955, MAXCURRENT_MA
+from panel_buffers import RGBV_CHANNEL
+
+CHANNELS = ('R', 'G', 'B', 'V', 'UV')
+
+Solution = namedtuple('Solution', 'pwm out_of_gamut error')
+Solution.__doc__ = """pwm : pwm fractions (...,5) within [0,1], ready for TLC5955.pwm_code
+out_of_gamut : (...) True where no pwm fractions within [0,1] reach the target
+error : (...) relative error of the receptor catches after clipping"""
+
+def integration_weights(wavelengths):
+    """trapezoid rule weights for spectra sampled at wavelengths"""
+    wl = np.asarray(wavelengths, np.float64)
+    w = np.zeros_like(wl)
+    d = np.diff(wl)/2
+    w[:-1] += d
+    w[1:] += d
+    return w
+
+class ColorEngine:
+    def __init__(self, wavelengths, spectra, sensitivities, maxcurrent, brightness):
+        """
+        wavelengths : (L,) sample wavelengths
+        spectra : (5,L) radiance of each channel (R,G,B,V,UV) at full PWM
+        sensitivities : (n,L) receptor spectral sensitivities
+        maxcurrent, brightness : R,G,B,V codes the spectra were measured with
+        """
+        spectra = np.asarray(spectra, np.float64)
+        sensitivities = np.asarray(sensitivities, np.float64)
+        if spectra.shape[0] != len(CHANNELS):
+            raise ValueError(f'spectra must have shape (5, L), got {spectra.shape}')
+        w = integration_weights(wavelengths)
+        #catch of each receptor from each channel at full PWM, as measured
+        self.catch_matrix = (sensitivities * w) @ spectra.T
+        self.reference_gain = self.channel_gain(maxcurrent, brightness)
+        self._cache = {} #(maxcurrent, brightness) -> (mixing, inverse, faces)
+
+    @property
+    def receptors(self):
+        return self.catch_matrix.shape[0]
+
+    @staticmethod
+    def channel_gain(maxcurrent, brightness):
+        """LED current of each channel (5,) for R,G,B,V max current and brightness codes, mA"""
+        mc = np.asarray(maxcurrent, np.intp)[RGBV_CHANNEL]
+        bc = np.asarray(brightness)[RGBV_CHANNEL]
+        return MAXCURRENT_MA[mc] * TLC5955.brightness(bc)
+
+    def _matrices(self, maxcurrent, brightness):
+        key = (tuple(int(c) for c in maxcurrent), tuple(int(c) for c in brightness))
+        m = self._cache.get(key)
+        if m is None:
+            mixing = self.catch_matrix * (self.channel_gain(*key) / self.reference_gain)
+            m = self._cache[key] = (mixing, np.linalg.pinv(mixing), self._faces(mixing))
+        return m
+
+    @staticmethod
+    def _faces(mixing):
+        """(free, on, inverse) for every face of the [0,1] box except its interior:
+        channels not in free or on are off, inverse solves for the free channels"""
+        faces = []
+        for state in itertools.product((0, 1, 2), repeat=len(CHANNELS)): #off, on, free
+            state = np.array(state)
+            free, on = np.flatnonzero(state == 2), np.flatnonzero(state == 1)
+            if len(free) < len(CHANNELS):
+                faces.append((free, on, np.linalg.pinv(mixing[:, free])))
+        return faces
+
+    @staticmethod
+    def _feasible(catches, mixing, faces, upper, tol=1e-9):
+        """minimum norm pwm (m,5) within [0, upper] reaching catches (m,n), NaN where there is none
+        
+        The minimum norm solution lies inside some face of the box, where it is the
+        minimum norm solution for the free channels with the rest held at their bounds.
+        """
+        best = np.full(catches.shape[:-1] + (len(CHANNELS),), np.nan)
+        best_norm = np.full(catches.shape[:-1], np.inf)
+        scale = np.linalg.norm(catches, axis=-1) + tol
+        for free, on, inverse in faces:
+            pwm = np.zeros_like(best)
+            pwm[:, on] = upper[:, on]
+            rest = catches - pwm[:, on] @ mixing[:, on].T
+            pwm[:, free] = rest @ inverse.T
+            ok = ((pwm >= -tol) & (pwm <= upper + tol)).all(-1)
+            ok &= np.linalg.norm(pwm @ mixing.T - catches, axis=-1) <= tol*scale
+            norm = np.einsum('ij,ij->i', pwm, pwm)
+            ok &= norm < best_norm
+            best[ok] = pwm[ok]
+            best_norm[ok] = norm[ok]
+        return np.clip(best, 0, upper)
+
+    def mixing(self, maxcurrent, brightness):
+        """receptor catches per unit pwm fraction (n,5) with the given settings"""
+        return self._matrices(maxcurrent, brightness)[0]
+
+    def inverse(self, maxcurrent, brightness):
+        """pwm fractions per unit receptor catch (5,n) with the given settings"""
+        return self._matrices(maxcurrent, brightness)[1]
+
+    def catches(self, pwm, maxcurrent, brightness):
+        """receptor catches (...,n) of pwm fractions (...,5)"""
+        return np.asarray(pwm) @ self.mixing(maxcurrent, brightness).T
+
+    def solve(self, catches, maxcurrent, brightness, clip='scale', pixel_gain=None):
+        """pwm fractions that produce the receptor catches (...,n)
+
+        Returns the minimum norm pwm within [0,1] that reaches the catches, if there is one.
+        clip : how to bring out of gamut solutions into [0,1]
+               'scale' clips negatives to 0, then dims channels over 1 uniformly to keep their ratios
+               'clip' clips each channel to [0,1]
+        pixel_gain : optional relative output of each pixel (...,5), eg. a residual flat field,
+                     which the pwm is divided by before clipping
+        returns Solution
+        """
+        mixing, inverse, faces = self._matrices(maxcurrent, brightness)
+        catches = np.asarray(catches, np.float64)
+        lead = catches.shape[:-1]
+        catches = catches.reshape(-1, catches.shape[-1]) #one row per pixel
+        gain = None if pixel_gain is None else np.broadcast_to(pixel_gain, lead + (len(CHANNELS),)).reshape(-1, len(CHANNELS))
+        pwm = catches @ inverse.T
+        if gain is not None:
+            pwm /= gain
+        out_of_gamut = ((pwm < 0) | (pwm > 1)).any(-1)
+        if out_of_gamut.any():
+            #the minimum norm solution is outside [0,1], but another may be inside
+            upper = np.ones(pwm.shape) if gain is None else gain
+            feasible = self._feasible(catches[out_of_gamut], mixing, faces, upper[out_of_gamut])
+            if gain is not None:
+                feasible /= upper[out_of_gamut]
+            found = ~np.isnan(feasible[:, 0])
+            rows = np.flatnonzero(out_of_gamut)
+            pwm[rows[found]] = feasible[found]
+            out_of_gamut[rows[found]] = False
+        np.maximum(pwm, 0, out=pwm)
+        if clip == 'scale':
+            peak = pwm.max(-1, keepdims=True)
+            np.divide(pwm, np.maximum(peak, 1), out=pwm)
+        elif clip == 'clip':
+            np.minimum(pwm, 1, out=pwm)
+        else:
+            raise ValueError(f'unknown clip mode: {clip}')
+        achieved = pwm * gain if gain is not None else pwm
+        achieved = achieved @ mixing.T
+        norm = np.linalg.norm(catches, axis=-1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            error = np.where(norm > 0, np.linalg.norm(achieved - catches, axis=-1)/norm, 0.0)
+        return Solution(pwm.reshape(lead + (len(CHANNELS),)), out_of_gamut.reshape(lead), error.reshape(lead))
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+LED current drawn by the panel, estimated from the codes it is sent.
+"""
+
+import numpy as np
+from TLC5955 import TLC5955, MAXCURRENT_MA
+from panel_buffers import PANEL_DIMS, CHIP_LEDS, pixel_addr_lut, chip_codes, unpack_ctrl
+
+class CurrentEstimator:
+    """LED current drawn by the panel, in mA, from its codes
+    
+    Each LED draws maxcurrent * brightness * dotcorrect * pwm/65536 of its chip and
+    channel, using the TLC5955 codec tables. This is the estimate that Display::CurrQ
+    in the firmware was meant to make, but for any number of frames at once.
+    """
+    def __init__(self, dotcorrect, maxcurrent, brightness):
+        """dotcorrect : dot correct codes (8,12,5)
+        maxcurrent, brightness : R,G,B,V codes (4,), as DISP:MAXC and DISP:BRI, or per chip and channel (10,3)
+        """
+        mc, bc = np.asarray(maxcurrent), np.asarray(brightness)
+        if mc.shape == (4,): mc = chip_codes(mc)
+        if bc.shape == (4,): bc = chip_codes(bc)
+        chip, channel = np.divmod(pixel_addr_lut, CHIP_LEDS)
+        channel %= 3 #LEDs alternate between the chip's 3 channels
+        led = MAXCURRENT_MA[mc][chip, channel] * TLC5955.brightness(bc)[chip, channel]
+        #mA per pwm code of each pixel
+        self.gain = led.reshape(PANEL_DIMS) * TLC5955.dotcorrect_img(dotcorrect) / 65536
+
+    @classmethod
+    def from_ctrl(cls, ctrl_buffer):
+        """estimator for the settings in a ctrl_buffer (see panel_buffers)"""
+        ctrl = unpack_ctrl(ctrl_buffer)
+        return cls(ctrl.dotcorrect, ctrl.maxcurrent, ctrl.brightness)
+
+    def channels(self, pwm):
+        """current per channel (...,5) for pwm codes (...,8,12,5)"""
+        return np.einsum('...yxc,yxc->...c', pwm, self.gain)
+
+    def total(self, pwm):
+        """total current (...) for pwm codes (...,8,12,5)"""
+        return self.channels(pwm).sum(-1)
+
+    def govern(self, pwm, limit=None, channel_limit=None, out=None):
+        """scale down the frames that would draw more than the limits
+        
+        pwm : pwm codes (...,8,12,5)
+        limit : maximum total current, mA
+        channel_limit : maximum current of each channel (5,), mA
+        Frames over a limit are dimmed uniformly, which keeps their colour.
+        returns the governed pwm codes and the scale applied to each frame (...)
+        """
+        pwm = np.asarray(pwm)
+        current = self.channels(pwm)
+        scale = np.ones(current.shape[:-1])
+        with np.errstate(divide='ignore'):
+            if limit is not None:
+                np.minimum(scale, limit/current.sum(-1), out=scale)
+            if channel_limit is not None:
+                np.minimum(scale, (np.asarray(channel_limit)/current).min(-1), out=scale)
+        if out is None:
+            out = np.empty(pwm.shape, np.uint16)
+        scaled = np.multiply(pwm, scale[..., None, None, None])
+        np.floor(scaled, out=scaled)
+        np.copyto(out, scaled, casting='unsafe')
+        return out, scale
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+"""
+Temporal dithering of PWM codes.
+
+Dim channels (eg. UV and violet targets around 1e-3 of full scale) only have a
+few PWM codes to work with. Spreading the fractional part of the code over
+several frames makes the time average match the float target much more closely.
+
+error_diffusion() carries each frame's rounding error into the next, which is
+computed for a whole (T,8,12,5) stack at once from the running sum of the
+target. DitherSchedule repeats each frame N times, adding a fixed set of
+thresholds spread evenly over [0,1), so that the N frames average to the
+target to within 1/N of a code.
+
+Both return uint16 codes, as TLC5955.pwm_code does, ready for SCPIProtocol.stream.
+Fractions are of full scale, so code 65535 is 1.0, as TLC5955.pwm_img.
+"""
+
+import numpy as np
+
+PWM_MAX = 65535
+
+def error_diffusion(frames, phase=0.5, out=None):
+    """pwm codes (T,...) whose running sum tracks that of the pwm fractions frames (T,...)
+
+    code_t = floor(phase + S_t) - floor(phase + S_t-1), S_t = 65535 * sum of frames[:t+1]
+    so the error of the average over any run of frames is below 1 code / run length.
+    phase : starting error, scalar or per pixel (...). Random phases decorrelate the pixels.
+    """
+    frames = np.asarray(frames, np.float64)
+    total = np.clip(frames, 0.0, 1.0)
+    total = np.multiply(total, PWM_MAX) #new array, so frames is left as it is
+    np.cumsum(total, axis=0, out=total)
+    total += phase
+    np.floor(total, out=total)
+    if out is None:
+        out = np.empty(frames.shape, np.uint16)
+    np.copyto(out[1:], np.diff(total, axis=0), casting='unsafe')
+    np.copyto(out[:1], total[:1] - np.floor(phase), casting='unsafe')
+    return out
+
+def _bit_reversed(n):
+    """0..n-1 in an order that spreads consecutive values apart (bit reversal, for any n)"""
+    bits = max(1, (n-1).bit_length())
+    k = np.arange(1 << bits)
+    rev = np.zeros_like(k)
+    for b in range(bits):
+        rev |= ((k >> b) & 1) << (bits - 1 - b)
+    return rev[rev < n]
+
+class DitherSchedule:
+    """a precomputed ordered dither over n frames"""
+    def __init__(self, n):
+        self.n = n
+        #the frames that round up first are spread out in time
+        self.thresholds = (_bit_reversed(n) + 0.5)/n
+
+    def apply(self, frames, out=None):
+        """dither each frame of frames (T,...) over n frames: returns codes (T*n,...)
+
+        frame i of the input becomes frames i*n to (i+1)*n-1 of the output
+        """
+        frames = np.asarray(frames, np.float64)
+        codes = np.clip(frames, 0.0, 1.0)[:, None]*PWM_MAX
+        thresholds = self.thresholds.reshape((1, self.n) + (1,)*(frames.ndim-1))
+        codes = np.floor(codes + thresholds)
+        np.minimum(codes, PWM_MAX, out=codes)
+        shape = (frames.shape[0]*self.n,) + frames.shape[1:]
+        if out is None:
+            out = np.empty(shape, np.uint16)
+        np.copyto(out, codes.reshape(shape), casting='unsafe')
+        return out
+
+    def frame(self, frame, out=None):
+        """dither one frame (...) over n frames: returns codes (n,...)"""
+        return self.apply(np.asarray(frame)[None], out)
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""
+Max current and brightness settings for a stimulus set.
+
+An LED's output at full PWM is proportional to its channel's gain,
+maxcurrent_mA(mc) * brightness(bc), so a stimulus set needs a gain at least as
+large as its brightest pixel in each channel. Any more than that is wasted PWM
+range: a channel whose brightest pixel is at 1% of full PWM only uses 655 of
+its 65536 codes. All 8*128 (mc, bc) gains are tabulated once and sorted, and
+the smallest sufficient gain is looked up for every channel at once.
+
+The smallest sufficient gain is also the one that draws the least current
+at full PWM, so a current limit only matters when the stimulus set cannot
+be shown within it. Then the whole set is dimmed uniformly, which keeps its
+colours, and the scale is returned with the settings.
+
+V and UV share the V settings, as DISP:MAXC and DISP:BRI set them.
+"""
+
+import numpy as np
+from collections import namedtuple
+from TLC5955 import TLC5955, MAXCURRENT_MA
+from panel_buffers import PANEL_CHANNELS, RGBV_CHANNEL
+
+Settings = namedtuple('Settings', 'maxcurrent brightness scale peak current')
+Settings.__doc__ = """maxcurrent, brightness : R,G,B,V codes (4,)
+scale : dimming applied to the stimulus set to stay within the current limits (1 if none)
+peak : brightest pwm fraction of each channel (5,) with the new settings
+current : current drawn by each R,G,B,V group at full PWM (4,), mA"""
+
+#every (maxcurrent, brightness) code pair, sorted by gain then by maxcurrent
+_MC, _BC = [c.ravel() for c in np.meshgrid(np.arange(8), np.arange(128), indexing='ij')]
+_GAIN = MAXCURRENT_MA[_MC] * TLC5955.brightness(_BC)
+_ORDER = np.lexsort((_MC, _GAIN))
+_MC, _BC, _GAIN = _MC[_ORDER], _BC[_ORDER], _GAIN[_ORDER]
+
+def gain(maxcurrent, brightness):
+    """full PWM current of an LED with R,G,B,V codes (...,4), mA"""
+    return MAXCURRENT_MA[np.asarray(maxcurrent, np.intp)] * TLC5955.brightness(np.asarray(brightness))
+
+def _rgbv_max(x):
+    """max of (...,5) over V and UV: (...,4)"""
+    return np.concatenate([x[..., :3], x[..., 3:].max(-1, keepdims=True)], -1)
+
+def optimize(stimuli, maxcurrent, brightness, dotcorrect, limit=None, channel_limit=None):
+    """settings that give the stimulus set the most PWM resolution within the current limits
+
+    stimuli : pwm fractions (...,8,12,5) with the settings below. may exceed 1
+    maxcurrent, brightness : R,G,B,V codes (4,) the stimuli were made for
+    dotcorrect : dot correct codes (8,12,5)
+    limit : maximum total current with every LED at full PWM, mA
+    channel_limit : maximum current of each R,G,B,V group at full PWM (4,), mA
+    returns Settings. The stimuli with the new settings are rescale(stimuli, settings, maxcurrent, brightness)
+    """
+    stimuli = np.asarray(stimuli, np.float64)
+    stimuli = stimuli.reshape((-1,) + stimuli.shape[-3:])
+    #gain each group needs, mA at full PWM
+    needed = _rgbv_max(stimuli.max((0, 1, 2))) * gain(maxcurrent, brightness)
+    #full PWM current per mA of gain of each group: the sum of its dot correct
+    dc = TLC5955.dotcorrect_img(np.asarray(dotcorrect)).reshape(-1, PANEL_CHANNELS).sum(0)
+    leds = np.bincount(RGBV_CHANNEL, dc, 4)
+
+    floor = _GAIN[0]*leds #current at the smallest gain
+    if limit is not None and limit < floor.sum():
+        raise ValueError(f'limit is below the smallest possible current, {floor.sum():.1f} mA')
+    #most gain each group may have
+    top = np.full(4, len(_GAIN) - 1)
+    if channel_limit is not None:
+        channel_limit = np.asarray(channel_limit, np.float64)
+        if np.any(channel_limit < floor):
+            raise ValueError(f'channel_limit is below the smallest possible currents, {floor} mA')
+        top = np.minimum(top, np.searchsorted(_GAIN, channel_limit/leds, 'right') - 1)
+    scale = 1.0
+    if limit is not None and np.maximum(needed*leds, floor).sum() > limit:
+        #groups held at the smallest gain do not get dimmer, so the rest make up for them
+        for k in range(4):
+            held = needed*scale <= _GAIN[0]
+            if held.all(): break
+            scale = (limit - floor[held].sum())/(needed[~held] @ leds[~held])
+    target = needed*scale
+    i = np.clip(np.searchsorted(_GAIN, target, 'left'), 0, top)
+    if limit is not None and _GAIN[i] @ leds > limit:
+        #rounding the gains up broke the limit: round them down instead
+        i = np.clip(np.searchsorted(_GAIN, target, 'right') - 1, 0, top)
+    short = _GAIN[i] < target
+    if short.any():
+        #dim everything as much as the channel furthest short of its target
+        scale = min(scale, (_GAIN[i][short]/needed[short]).min())
+        #which leaves room to turn the other groups down
+        i = np.minimum(i, np.searchsorted(_GAIN, needed*scale*(1 - 1e-12), 'left'))
+    settings = Settings(_MC[i], _BC[i], scale, None, _GAIN[i]*leds)
+    return settings._replace(peak=rescale(stimuli.max((0, 1, 2)), settings, maxcurrent, brightness))
+
+def rescale(stimuli, settings, maxcurrent, brightness):
+    """pwm fractions (...,5) with the settings maxcurrent, brightness -> with the new Settings"""
+    ratio = gain(maxcurrent, brightness) / gain(settings.maxcurrent, settings.brightness)
+    return np.asarray(stimuli) * (settings.scale * ratio[RGBV_CHANNEL])
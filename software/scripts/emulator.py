@@ -0,0 +1,846 @@
+# -*- coding: utf-8 -*-
+"""
+Software model of the UVTV panel controller.
+
+PanelEmulator speaks the same SCPI dialect as the firmware in
+software/controller/src/main.cpp: the same command table, the same output
+formatting quirks of scpi-parser (',' between items, ';' between units that
+produced output, CRLF only when something was written, **ERROR** in place of a
+failed result) and the same pwm/control buffer layouts, so readbacks are byte
+for byte what the board would send.
+
+PtyPanel serves an emulator on a pseudo-terminal, so that scripts written for
+the real panel can run unchanged by pointing them at its port:
+
+    with PtyPanel() as panel:
+        with Serial(panel.port) as port, SCPIProtocol(port) as scpi:
+            scpi.command(b'*IDN?', True)
+
+Run this file directly to serve a panel until Ctrl-C.
+
+Known differences from the board:
+ - *RST resets the emulator's state and finishes the line instead of dropping the USB connection
+ - SYST:PROG does nothing
+ - DISP:CURR? is an execution error (the firmware handler has no return value)
+ - input is processed in 16 byte chunks as the firmware does, but without its timing
+"""
+
+import os
+import re
+import threading
+import numpy as np
+from collections import deque
+from TLC5955 import SCPIPacketizer
+from panel_buffers import (PANEL_DIMS, PANEL_HEIGHT, PANEL_WIDTH, PANEL_CHANNELS, PANEL_CHIPS, NUM_LEDS,
+                           PWM_BUFFER_SIZE, CTRL_BUFFER_SIZE, RGB_CHIPS, UV_CHIPS, DC_OFFSET, MC_OFFSET,
+                           BC_OFFSET, FC_OFFSET, MAGIC, pixel_addr_lut, pack_pwm, unpack_pwm,
+                           set_dotcorrect, get_dotcorrect)
+
+SER_LEN = 8
+ROM_SER, ROM_BR, ROM_CTRL = 0, 8, 32
+EEPROM_SIZE = 2048
+F_CPU = 96000000
+
+SCPI_IDN = (b'"Samuel Powell"', b'UVTV', None, b'2020-11-02') #serial number is read from EEPROM
+SCPI_INPUT_BUFFER_SIZE = 1024
+SCPI_ERROR_QUEUE_SIZE = 4
+SER_BUFFER_LEN = 16
+
+#scpi-parser error codes, as in its minimal error list
+ERRORS = {
+    0: 'No error',
+    -101: 'Invalid character',
+    -103: 'Invalid separator',
+    -104: 'Data type error',
+    -108: 'Parameter not allowed',
+    -109: 'Missing parameter',
+    -113: 'Undefined header',
+    -151: 'Invalid string data',
+    -200: 'Execution error',
+    -224: 'Illegal parameter value',
+    -310: 'System error',
+    -350: 'Queue overflow',
+    -363: 'Input buffer overrun',
+}
+
+def _get_bits(buffer, offset, n):
+    """read n <= 8 bits starting at bit offset, LSB first as TLC5955::copy_bits"""
+    i, b = divmod(int(offset), 8)
+    word = int.from_bytes(buffer[i:i+2], 'little')
+    return (word >> b) & ((1 << n) - 1)
+
+def _set_bits(buffer, offset, n, value):
+    """write the low n <= 8 bits of value starting at bit offset"""
+    i, b = divmod(int(offset), 8)
+    k = min(2, len(buffer) - i)
+    word = int.from_bytes(buffer[i:i+k], 'little')
+    mask = ((1 << n) - 1) << b
+    word = (word & ~mask) | ((value << b) & mask)
+    buffer[i:i+k] = word.to_bytes(k, 'little')
+
+def spi_baudrate(PBR, DBR, BR):
+    return (F_CPU * (1 + DBR)) // ((2, 3, 5, 7)[PBR] * (2 << BR))
+
+def _pattern(pattern):
+    """compile a command pattern like 'SYSTem:ERRor[:NEXT]?' to a regex matching its short and long forms"""
+    regex = ''
+    for token in re.findall(r'[A-Za-z*]+|.', pattern):
+        if token == '[': regex += '(?:'
+        elif token == ']': regex += ')?'
+        elif token in ':?': regex += re.escape(token)
+        else:
+            short = ''.join(c for c in token if not c.islower())
+            regex += f'(?:{re.escape(token.upper())}|{re.escape(short)})'
+    return re.compile(regex.encode(), re.IGNORECASE)
+
+def _match_choice(name, word):
+    """match a mnemonic against a choice name in short or long form"""
+    short = ''.join(c for c in name if not c.islower())
+    return word.upper() in (name.upper().encode(), short.encode())
+
+#lexer for program data
+_NUMBER = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?')
+_NONDECIMAL = re.compile(rb'#([HhQqBb])([0-9A-Fa-f]+)')
+_MNEMONIC = re.compile(rb'[A-Za-z][A-Za-z0-9_]*')
+
+class _Params:
+    """the program data of one command, read one parameter at a time as the firmware does"""
+    def __init__(self, panel, data : bytes):
+        self.panel = panel
+        self.data = data
+        self.pos = 0
+        self._skip()
+
+    def _skip(self):
+        while self.pos < len(self.data) and self.data[self.pos] in b' \t\r\n':
+            self.pos += 1
+
+    def remaining(self):
+        return self.pos < len(self.data)
+
+    def _token(self):
+        """lex the next parameter: returns (kind, value) or None"""
+        data, i = self.data, self.pos
+        c = data[i:i+1]
+        m = None
+        if c == b'#' and data[i+1:i+2].isdigit() and data[i+1:i+2] != b'0':
+            d = data[i+1] - 0x30
+            try:
+                n = int(data[i+2:i+2+d])
+            except ValueError:
+                return None
+            start = i+2+d
+            if start + n > len(data): return None
+            token, self.pos = ('block', data[start:start+n]), start+n
+        elif c in (b'"', b"'"):
+            j = i+1
+            while True:
+                j = data.find(c, j)
+                if j == -1: return None
+                if data[j+1:j+2] != c: break
+                j += 2 #doubled quote
+            token, self.pos = ('string', data[i+1:j].replace(c+c, c)), j+1
+        elif (m := _NONDECIMAL.match(data, i)):
+            base = {b'H':16, b'Q':8, b'B':2}[m.group(1).upper()]
+            try:
+                token = ('number', int(m.group(2), base))
+            except ValueError:
+                return None
+            self.pos = m.end()
+        elif (m := _NUMBER.match(data, i)):
+            text = m.group()
+            token = ('number', int(text) if text.lstrip(b'+-').isdigit() else float(text))
+            self.pos = m.end()
+        elif (m := _MNEMONIC.match(data, i)):
+            token, self.pos = ('mnemonic', m.group()), m.end()
+        else:
+            return None
+        self._skip()
+        if self.pos < len(data):
+            if data[self.pos] != 0x2c: #','
+                return None
+            self.pos += 1
+            self._skip()
+        return token
+
+    def parameter(self, mandatory):
+        """next parameter, or None after pushing the appropriate error"""
+        if not self.remaining():
+            if mandatory: self.panel._error(-109)
+            return None
+        token = self._token()
+        if token is None:
+            self.pos = len(self.data)
+            self.panel._error(-103)
+        return token
+
+    def uint32(self, mandatory=True):
+        token = self.parameter(mandatory)
+        if token is None: return None
+        kind, value = token
+        if kind != 'number':
+            self.panel._error(-104)
+            return None
+        return int(value) % 2**32 #strtoul wraps negative numbers
+
+    def uint32_array(self, count, mandatory=True):
+        values = []
+        while len(values) < count:
+            v = self.uint32(mandatory)
+            if v is None: break
+            values.append(v)
+            mandatory = False
+        return values if not mandatory else None
+
+    def bool(self, mandatory=True):
+        token = self.parameter(mandatory)
+        if token is None: return None
+        kind, value = token
+        if kind == 'number' and isinstance(value, int):
+            return value != 0
+        for name, v in (('OFF', False), ('ON', True)):
+            if kind == 'mnemonic' and _match_choice(name, value):
+                return v
+        self.panel._error(-224)
+        return None
+
+    def choice(self, token, choices):
+        kind, value = token
+        if kind == 'mnemonic':
+            for i, name in enumerate(choices):
+                if _match_choice(name, value):
+                    return i
+        self.panel._error(-224)
+        return None
+
+    def characters(self, mandatory=True):
+        token = self.parameter(mandatory)
+        if token is None: return None
+        kind, value = token
+        if kind == 'number': #characters are returned as written
+            return str(value).encode()
+        return value
+
+    def block(self, mandatory=True):
+        token = self.parameter(mandatory)
+        if token is None: return None
+        kind, value = token
+        if kind != 'block':
+            self.panel._error(-104)
+            return None
+        return value
+
+class PanelEmulator:
+    """
+    The panel controller firmware, without the panel.
+
+    Feed the bytes sent by the host to input(), which returns the bytes the
+    board would send back.
+    """
+    MODE_CHOICES = ('Dsprpt', 'Tmgrst', 'Rfresh', 'Espwm', 'Lsdvlt')
+
+    def __init__(self, serial='0', eeprom=None):
+        if eeprom is None:
+            eeprom = bytearray(b'\xff'*EEPROM_SIZE) #erased flash
+            eeprom[ROM_SER:ROM_SER+SER_LEN] = bytes(str(serial),'ascii')[:SER_LEN].ljust(SER_LEN, b'\0')
+        self.eeprom = bytearray(eeprom)
+        self.commands = [(_pattern(p), getattr(self, h), tag) for p, h, tag in self.COMMANDS]
+        self.reset()
+
+    COMMANDS = [ #{pattern, callback, tag} as main.cpp
+        ('*IDN?', '_idn', 0),
+        ('*RST', '_rst', 0),
+        ('SYSTem:ERRor[:NEXT]?', '_err_next', 0),
+        ('SYSTem:ERRor:COUNt?', '_err_count', 0),
+        ('HELP', '_help', 0),
+        ('SYSTem:HELP:HEADers?', '_help', 1),
+        ('SYSTem:PROGram', '_prog', 0),
+        ('SYSTem:SERial', '_ser', 0),
+        ('SYSTem:SERial?', '_ser_q', 0),
+        ('SYSTem:ERRor:ALL?', '_err_all', 0),
+        ('SYSTem:COMMunicate:ECHO', '_echo', 0),
+        ('SYSTem:COMMunicate:ECHO?', '_echo_q', 0),
+        ('DISPlay[:ENable]', '_en', 0),
+        ('DISPlay[:ENable]?', '_en_q', 0),
+        ('DISPlay:MODE', '_mode', 0),
+        ('DISPlay:MODE?', '_mode_q', 0),
+        ('DISPlay:GEOMetry?', '_geom_q', 0),
+        ('DISPlay:MAXCurrent', '_maxc', 0),
+        ('DISPlay:MAXCurrent?', '_maxc_q', 0),
+        ('DISPlay:BRIghtness', '_bri', 0),
+        ('DISPlay:BRIghtness?', '_bri_q', 0),
+        ('DISPlay:DOTCorrect', '_dotc', 0),
+        ('DISPlay:DOTCorrect?', '_dotc_q', 0),
+        ('DISPlay:DOTCorrect:ALL', '_dotc_all', 0),
+        ('DISPlay:DOTCorrect:ALL?', '_dotc_all_q', 0),
+        ('DISPlay:CURRent?', '_curr_q', 0),
+        ('DISPlay:SAVE', '_save', 0),
+        ('DISPlay:LOAD', '_load', 0),
+        ('DISPlay:PWM', '_pwm', 0),
+        ('DISPlay:PWM?', '_pwm_q', 0),
+        ('DISPlay:PWM:ALL', '_pwm_all', 0),
+        ('DISPlay:PWM:ALL?', '_pwm_all_q', 0),
+        ('DISPlay:SPIFrequency', '_spif', 0),
+        ('DISPlay:SPIFrequency?', '_spif_q', 0),
+        ('DISPlay:REFResh', '_refr', 0),
+        ('DISPlay:LUT?', '_lut_q', 0),
+    ]
+
+    HELP = [ #{syntax, description} as main.cpp
+        ('HELP', 'Print this help message'),
+        ('SYSTem:HELP:HEADers?', 'List all commands'),
+        ('*IDN?', 'Identification'),
+        ('*RST', 'Software Reset'),
+        ('SYSTem:ERRor[:NEXT]?', 'Pop first error in queue.'),
+        ('SYSTem:ERRor:COUNt?', 'Number of unread errors.'),
+        ('SYSTem:ERRor:ALL?', 'List all current errors'),
+        ('SYSTem:PROGram', 'Reboot into bootloader for programming'),
+        ('SYSTem:SERial?', 'The device serial number, as reported by *IDN?'),
+        ('SYSTem:COMMunicate:ECHO[?] ON|OFF', 'Enable serial echo'),
+        ('DISPlay[:ENable][?]', 'Turn panel on or off'),
+        ('DISPlay:GEOMetry?', 'Return HEIGHT,WIDTH,CHANNELS of the panel'),
+        ('DISPlay:MODE[?]', '5-bit Function Control register. Accepts a number or a list of named options:\r\n    Dsprpt, Tmgrst, Rfresh, Espwm, Lsdvlt\r\n  D,E is probably what you want.'),
+        ('DISPlay:MAXCurrent[?]', 'R,G,B,V: 4x 3-bit maximum current code. UV uses the same max current as V.'),
+        ('DISPlay:BRIghtness[?]', 'R,G,B,V: 4x 7-bit brightness code. UV uses the same brightness as V.'),
+        ('DISPlay:DOTCorrect[?]', 'y,x,c[,DC]: 7-bit dot correct code for LED at (y,x,c)'),
+        ('DISPlay:DOTCorrect:ALL[?]', 'All dot correct codes, binary encoded each in 1 byte.'),
+        ('DISPlay:SAVE', 'Save SPIFreq, MODE, MAXCurrent, and DOTCorrect values'),
+        ('DISPlay:LOAD', 'Load SPIFreq, MODE, MAXCurrent, and DOTCorrect values'),
+        ('DISPlay:PWM[?]', 'y,x,c[,PWM]: 16-bit PWM code for LED at (y,x,c)'),
+        ('DISPlay:PWM:ALL[?]', 'All PWM codes, binary encoded each in 2 bytes.'),
+        ('DISPlay:CURRent?', 'Estimate current required to display image.'),
+        ('DISPlay:SPIFrequency[?]', 'f: set frequency, returns actual.'),
+        ('DISPlay:REFResh', '(Re)send PWM codes to panel.'),
+    ]
+
+    SYSTEM_HELP = (
+        'UVTV System Help\r\n'
+        '  This system uses the SCPI standard for communication and control.\r\n'
+        '  Send any of the following commands followed by ENTER to execute them.\r\n'
+        '  Commands are not case-sensitive, but have short and long forms. The short \r\n'
+        '  form is indicated by capitals. [] indicate optional parts.\r\n'
+        '  E.g. STATus:ERRor[:NEXT]?  can be executed by entering any of the following:\r\n'
+        '    "STAT:err?" or "status:error?" or "STATus:error:next?" etc.\r\n'
+        '  N.B. Many of the mandated commands are not implemented on this system.\r\n'
+        '\r\n'
+        '  Image data is specified in a row-major interleaved format. Each pixel is\r\n'
+        '  5 16-bit values: R,G,B,V,UV where 0000 is off and FFFF is on. Additionally,\r\n'
+        '  each color channel has a 3-bit maximum current and 7-bit brightness, and\r\n'
+        '  each pixel has a 7-bit dot correction, all of which control the LED drive\r\n'
+        '  current. See the TLC5955 datasheet for more information.\r\n'
+        '  Binary data is encoded using the SCPI block format: #<d><len><data>, where\r\n'
+        '    <d> and <len> are ASCII encoded decimal numbers,\r\n'
+        '    <d> is a single decimal digit, the number of digits in <len>, and\r\n'
+        '    <len> is the number of bytes in <data>.'
+        '\r\n\r\nCommands:\r\n')
+
+    def reset(self):
+        """power on state, as setup()"""
+        self.echo = True
+        self.enabled = False
+        self.br_flags = 0
+        self.pwm_buffer = bytearray(PANEL_CHIPS*PWM_BUFFER_SIZE)
+        self.ctrl_buffer = bytearray(PANEL_CHIPS*CTRL_BUFFER_SIZE)
+        for chip in range(PANEL_CHIPS):
+            self.ctrl_buffer[(chip+1)*CTRL_BUFFER_SIZE - 1] = MAGIC
+        #what the LED drivers were last sent
+        self.latched_pwm = bytes(len(self.pwm_buffer))
+        self.latched_ctrl = bytes(len(self.ctrl_buffer))
+        self.refreshes = 0
+        self.serial = bytes(self.eeprom[ROM_SER:ROM_SER+SER_LEN]).split(b'\0')[0]
+        self.errors = deque()
+        self._input = bytearray()
+        self._output = bytearray()
+        self._output_count = 0
+
+    ## buffer access
+
+    @property
+    def pwm(self):
+        """pwm codes as an image of shape PANEL_DIMS (a copy)"""
+        return unpack_pwm(np.frombuffer(self.pwm_buffer, np.uint8))
+
+    @property
+    def displayed(self):
+        """pwm codes being shown by the panel, as an image"""
+        if not self.enabled:
+            return np.zeros(PANEL_DIMS, np.uint16)
+        return unpack_pwm(np.frombuffer(self.latched_pwm, np.uint8))
+
+    @property
+    def dotcorrect(self):
+        """dot correct codes as an image of shape PANEL_DIMS"""
+        return get_dotcorrect(np.frombuffer(self.ctrl_buffer, np.uint8))
+
+    def _ctrl(self, chip):
+        return memoryview(self.ctrl_buffer)[chip*CTRL_BUFFER_SIZE:(chip+1)*CTRL_BUFFER_SIZE]
+
+    def get_baudrate(self):
+        PBR = (self.br_flags >> 16) & 3
+        DBR = 1 if self.br_flags & 0x80000000 else 0
+        BR = self.br_flags & 15
+        return spi_baudrate(PBR, DBR, BR)
+
+    def set_baudrate(self, rate):
+        """closest SPI rate the K20 can produce, as TLC5955::set_baudrate"""
+        rate = max(rate, 1)
+        best_PBR, best_DBR, best_BR = 0, 1, 0
+        best_rate = spi_baudrate(best_PBR, best_DBR, best_BR)
+        best_error = abs(best_rate - rate)
+        for DBR in (1, 0):
+            for PBR in range(4):
+                ratio = spi_baudrate(PBR, DBR, 0) // rate
+                BR = ratio.bit_length() - 1 if ratio > 0 else 15
+                for BRx in range(2):
+                    if BR + BRx >= 16: break
+                    guess = spi_baudrate(PBR, DBR, BR + BRx)
+                    error = abs(guess - rate)
+                    if error <= best_error:
+                        best_error, best_rate = error, guess
+                        best_PBR, best_DBR, best_BR = PBR, DBR, BR + BRx
+        self.br_flags = (best_PBR << 16) | (0x80000000 * best_DBR) | best_BR
+        return best_rate
+
+    ## serial input
+
+    def input(self, data : bytes):
+        """process bytes from the host. returns the bytes sent back"""
+        for i in range(0, len(data), SER_BUFFER_LEN):
+            chunk = data[i:i+SER_BUFFER_LEN]
+            if self.echo:
+                self._output += chunk
+            self._scpi_input(chunk)
+        output, self._output = bytes(self._output), bytearray()
+        return output
+
+    def _scpi_input(self, chunk):
+        """as SCPI_Input: buffer the chunk, then parse any complete messages"""
+        if len(chunk) > SCPI_INPUT_BUFFER_SIZE - len(self._input) - 1:
+            self._input.clear() #input buffer overrun - invalidate buffer
+            self._error(-363)
+            return
+        self._input += chunk
+        while (end := self._message_end(self._input)) > 0:
+            message = bytes(self._input[:end])
+            del self._input[:end]
+            self._parse(message)
+
+    @staticmethod
+    def _message_end(buffer):
+        """index just past the newline terminating the first message in buffer, or -1"""
+        i, n = 0, len(buffer)
+        while i < n:
+            c = buffer[i]
+            if c == 0x0a: #\n
+                return i+1
+            elif c in (0x22, 0x27): #quoted string
+                j = buffer.find(bytes((c,)), i+1)
+                if j == -1: return -1
+                i = j+1
+            elif c == 0x23 and i+1 < n and 0x31 <= buffer[i+1] <= 0x39: #arbitrary block
+                d = buffer[i+1] - 0x30
+                if i+2+d > n: return -1
+                try:
+                    i += 2 + d + int(buffer[i+2:i+2+d])
+                except ValueError:
+                    i += 1
+            else:
+                i += 1
+        return -1
+
+    ## output, as scpi-parser's writeData & co.
+
+    def _write(self, data : bytes):
+        self._output += data
+
+    def _result(self, data : bytes):
+        if self._output_count > 0:
+            self._write(b',')
+        self._write(data)
+        self._output_count += 1
+
+    def _error(self, code):
+        """as SCPI_ErrorPush, with the firmware's error callback"""
+        overflow = len(self.errors) >= SCPI_ERROR_QUEUE_SIZE
+        if overflow:
+            self.errors[-1] = -350
+        else:
+            self.errors.append(code)
+        self._result(b'**ERROR**')
+        if overflow:
+            self._result(b'**ERROR**')
+        self._cmd_error = True
+
+    def _result_error(self, code):
+        self._result(str(code).encode())
+        self._write(b',"' + ERRORS.get(code, 'Unknown error').encode() + b'"')
+
+    def _result_block(self, data : bytes):
+        #the block header is written without a delimiter
+        self._write(b'#%d%d' % (len(str(len(data))), len(data)))
+        self._write(data)
+        self._output_count += 1
+
+    ## parsing
+
+    def _parse(self, message : bytes):
+        """as SCPI_Parse: execute each unit of a message"""
+        self._output_count = 0
+        prev = None
+        message = message[:-1] #strip the newline, and a CR before it, but nothing of a block at the end
+        if message.endswith(b'\r'): message = message[:-1]
+        for unit in SCPIPacketizer._split_units(message):
+            m = re.match(rb'\s*([*:]?[A-Za-z0-9_*:]*\??)', unit)
+            header, data = m.group(1), unit[m.end():]
+            if not header:
+                if data.strip():
+                    self._error(-101)
+                continue
+            if prev is not None and header[:1] not in b'*:' and prev[:1] != b'*':
+                i = prev.rfind(b':')
+                if i >= 0: #relative to the previous command
+                    header = prev[:i+1] + header
+            command = self._find(header.lstrip(b':'))
+            if command is None:
+                self._error(-113)
+                continue
+            self._process(command, data)
+            prev = header
+        if self._output_count > 0:
+            self._write(b'\r\n')
+
+    def _find(self, header):
+        for pattern, handler, tag in self.commands:
+            if pattern.fullmatch(header):
+                return handler, tag
+        return None
+
+    def _process(self, command, data):
+        """as processCommand"""
+        handler, tag = command
+        if self._output_count > 0:
+            self._write(b';')
+        self._output_count = 0
+        self._cmd_error = False
+        params = _Params(self, data)
+        if not handler(params, tag) and not self._cmd_error:
+            self._error(-200)
+        if params.remaining() and not self._cmd_error:
+            self._error(-108)
+
+    ## commands. each returns True on success
+
+    def _idn(self, params, tag):
+        for item in SCPI_IDN:
+            self._result(self.serial if item is None else item)
+        return True
+
+    def _rst(self, params, tag):
+        self._result(b'**RESET**')
+        self._write(b'\r\n')
+        self.reset()
+        self._output_count = 0
+        return True
+
+    def _err_next(self, params, tag):
+        self._result_error(self.errors.popleft() if self.errors else 0)
+        return True
+
+    def _err_count(self, params, tag):
+        self._result(b'%d' % len(self.errors))
+        return True
+
+    def _err_all(self, params, tag):
+        self._result_error(self.errors.popleft() if self.errors else 0)
+        while self.errors:
+            self._result_error(self.errors.popleft())
+        return True
+
+    def _help(self, params, tag):
+        if tag == 0:
+            self._write(self.SYSTEM_HELP.encode())
+            for syntax, description in self.HELP:
+                self._write(f'{syntax}\r\n  {description}\r\n'.encode())
+        else:
+            for syntax, description in self.HELP:
+                self._write(f'{syntax}\r\n'.encode())
+        return True
+
+    def _prog(self, params, tag):
+        return True
+
+    def _ser(self, params, tag):
+        value = params.characters()
+        if value is None: return False
+        if len(value) > SER_LEN:
+            self._error(-151)
+            return False
+        self.serial = bytes(value)
+        self.eeprom[ROM_SER:ROM_SER+SER_LEN] = self.serial.ljust(SER_LEN, b'\0')
+        return True
+
+    def _ser_q(self, params, tag):
+        self._result(self.serial)
+        return True
+
+    def _echo(self, params, tag):
+        value = params.bool()
+        if value is None: return False
+        self.echo = value
+        return True
+
+    def _echo_q(self, params, tag):
+        self._result(b'1' if self.echo else b'0')
+        return True
+
+    def _en(self, params, tag):
+        en = params.bool(False)
+        if en is None:
+            if self.errors: return False #the firmware checks the whole error queue here
+            en = True
+        if en:
+            self.latched_ctrl = bytes(self.ctrl_buffer)
+            self.latched_pwm = bytes(self.pwm_buffer)
+            self.refreshes += 1
+        else:
+            self.latched_pwm = bytes(len(self.pwm_buffer))
+        self.enabled = en
+        return True
+
+    def _en_q(self, params, tag):
+        self._result(b'1' if self.enabled else b'0')
+        return True
+
+    def _mode(self, params, tag):
+        token = params.parameter(True)
+        if token is None: return False
+        if token[0] == 'number':
+            value = int(token[1]) % 2**32
+            if value > 0x1f:
+                self._error(-224)
+                return False
+            mode = value
+        else:
+            choice = params.choice(token, self.MODE_CHOICES)
+            if choice is None: return False
+            mode = 1 << choice
+            while params.remaining():
+                token = params.parameter(False)
+                if token is None: return False
+                choice = params.choice(token, self.MODE_CHOICES)
+                if choice is None: return False
+                mode |= 1 << choice
+        for chip in range(PANEL_CHIPS):
+            _set_bits(self._ctrl(chip), FC_OFFSET, 5, mode)
+        return True
+
+    def _mode_q(self, params, tag):
+        self._result(b'%d' % _get_bits(self._ctrl(0), FC_OFFSET, 5))
+        return True
+
+    def _geom_q(self, params, tag):
+        for d in PANEL_DIMS:
+            self._result(b'%d' % d)
+        return True
+
+    def _set_rgbv(self, params, offset, n_bits):
+        rgbv = []
+        for i in range(4):
+            v = params.uint32()
+            if v is None: return False
+            rgbv.append(v)
+        if max(rgbv) >= (1 << n_bits):
+            self._error(-224)
+            return False
+        r, g, b, v = rgbv
+        for chip in RGB_CHIPS:
+            for c, code in enumerate((r, g, b)):
+                _set_bits(self._ctrl(chip), offset(c), n_bits, code)
+        for chip in UV_CHIPS:
+            for c in range(3):
+                _set_bits(self._ctrl(chip), offset(c), n_bits, v)
+        return True
+
+    def _get_rgbv(self, offset, n_bits):
+        rgb, uv = self._ctrl(RGB_CHIPS[0]), self._ctrl(UV_CHIPS[0])
+        for code in [_get_bits(rgb, offset(c), n_bits) for c in range(3)] + [_get_bits(uv, offset(0), n_bits)]:
+            self._result(b'%d' % code)
+        return True
+
+    def _maxc(self, params, tag):
+        return self._set_rgbv(params, MC_OFFSET, 3)
+
+    def _maxc_q(self, params, tag):
+        return self._get_rgbv(MC_OFFSET, 3)
+
+    def _bri(self, params, tag):
+        return self._set_rgbv(params, BC_OFFSET, 7)
+
+    def _bri_q(self, params, tag):
+        return self._get_rgbv(BC_OFFSET, 7)
+
+    def _led(self, params, n, limit=None):
+        """read y,x,c[,v] and return (led address, v), or None after pushing an error"""
+        values = params.uint32_array(n)
+        if values is None: return None
+        if (len(values) != n or values[0] >= PANEL_HEIGHT or values[1] >= PANEL_WIDTH
+                or values[2] >= PANEL_CHANNELS or (limit is not None and values[3] > limit)):
+            self._error(-224)
+            return None
+        y, x, c = values[:3]
+        led = pixel_addr_lut[c + PANEL_CHANNELS*(x + PANEL_WIDTH*y)]
+        return led, (values[3] if n > 3 else None)
+
+    def _dotc(self, params, tag):
+        led = self._led(params, 4, 0x7f)
+        if led is None: return False
+        _set_bits(self.ctrl_buffer, DC_OFFSET(led[0]), 7, led[1])
+        return True
+
+    def _dotc_q(self, params, tag):
+        led = self._led(params, 3)
+        if led is None: return False
+        self._result(b'%d' % _get_bits(self.ctrl_buffer, DC_OFFSET(led[0]), 7))
+        return True
+
+    def _dotc_all(self, params, tag):
+        value = params.block()
+        if value is None: return False
+        if len(value) != NUM_LEDS:
+            self._error(-224)
+            return False
+        dc = np.frombuffer(value, np.uint8).reshape(PANEL_DIMS)
+        set_dotcorrect(np.frombuffer(self.ctrl_buffer, np.uint8), dc)
+        return True
+
+    def _dotc_all_q(self, params, tag):
+        self._result_block(self.dotcorrect.tobytes())
+        return True
+
+    def _curr_q(self, params, tag):
+        return False
+
+    def _save(self, params, tag):
+        self.eeprom[ROM_BR:ROM_BR+4] = self.br_flags.to_bytes(4, 'little')
+        self.eeprom[ROM_CTRL:ROM_CTRL+len(self.ctrl_buffer)] = self.ctrl_buffer
+        return True
+
+    def _load(self, params, tag):
+        self.br_flags = int.from_bytes(self.eeprom[ROM_BR:ROM_BR+4], 'little')
+        self.ctrl_buffer[:] = self.eeprom[ROM_CTRL:ROM_CTRL+len(self.ctrl_buffer)]
+        return True
+
+    def _pwm(self, params, tag):
+        led = self._led(params, 4, 0xffff)
+        if led is None: return False
+        led, v = led
+        self.pwm_buffer[2*led:2*led+2] = v.to_bytes(2, 'little')
+        return True
+
+    def _pwm_q(self, params, tag):
+        led = self._led(params, 3)
+        if led is None: return False
+        led = led[0]
+        self._result(b'#H%X' % int.from_bytes(self.pwm_buffer[2*led:2*led+2], 'little'))
+        return True
+
+    def _pwm_all(self, params, tag):
+        value = params.block()
+        if value is None: return False
+        if len(value) != len(self.pwm_buffer):
+            self._error(-224)
+            return False
+        pwm = np.frombuffer(value, '<u2').reshape(PANEL_DIMS)
+        pack_pwm(pwm, out=np.frombuffer(self.pwm_buffer, np.uint8))
+        return True
+
+    def _pwm_all_q(self, params, tag):
+        self._result_block(self.pwm.astype('<u2').tobytes())
+        return True
+
+    def _spif(self, params, tag):
+        value = params.uint32()
+        if value is None: return False
+        self._result(b'%d' % self.set_baudrate(value))
+        return True
+
+    def _spif_q(self, params, tag):
+        self._result(b'%d' % self.get_baudrate())
+        return True
+
+    def _refr(self, params, tag):
+        self.latched_pwm = bytes(self.pwm_buffer)
+        self.refreshes += 1
+        return True
+
+    def _lut_q(self, params, tag):
+        led = self._led(params, 3)
+        if led is None: return False
+        self._result(b'%d' % led[0])
+        return True
+
+class PtyPanel:
+    """
+    Serve a PanelEmulator on a pseudo-terminal (POSIX only).
+
+    Open port with serial.Serial to talk to the emulator as if it were a panel.
+    """
+    def __init__(self, emulator=None):
+        import pty, tty
+        self.emulator = PanelEmulator() if emulator is None else emulator
+        self._master, self._slave = pty.openpty()
+        tty.setraw(self._master)
+        tty.setraw(self._slave) #the slave stays open so that the port survives clients closing it
+        self.port = os.ttyname(self._slave)
+        self._lock = threading.Lock()
+        self._alive = False
+        self._thread = None
+
+    def start(self):
+        self._alive = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._alive = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        import select
+        while self._alive:
+            readable, _, _ = select.select([self._master], [], [], 0.1)
+            if not readable: continue
+            try:
+                data = os.read(self._master, 4096)
+            except OSError:
+                continue
+            with self._lock:
+                output = self.emulator.input(data)
+            view = memoryview(output)
+            while view:
+                n = os.write(self._master, view)
+                view = view[n:]
+
+if __name__ == '__main__':
+    import time
+    with PtyPanel() as panel:
+        print(f'Emulated panel on {panel.port}. Ctrl-C to quit')
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
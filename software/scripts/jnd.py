@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""
+Receptor noise limited colour distances (Vorobyev & Osorio 1998), in JNDs.
+
+For receptor catches qA, qB the log contrasts are df_i = ln(qA_i/qB_i) and,
+with receptor noise e_i, the distance is the noise-weighted length of df once
+its achromatic part (equal in every receptor) is removed:
+
+    dS^2 = df^T P df,  P = S - S 1 1^T S / (1^T S 1),  S = diag(1/e_i^2)
+
+which equals the published di-, tri- and tetrachromat formulas and works for any
+number of receptors. P is computed once, so distances between any broadcastable
+stacks of colours are a single einsum.
+"""
+
+import numpy as np
+from collections import namedtuple
+
+class ReceptorNoise:
+    def __init__(self, noise):
+        """noise : noise (Weber fraction) e_i of each receptor channel (n,)"""
+        e = np.asarray(noise, np.float64)
+        S = np.diag(1/e**2)
+        s1 = S.sum(1)
+        self.noise = e
+        self.metric = S - np.outer(s1, s1)/s1.sum()
+
+    @classmethod
+    def from_abundance(cls, weber, abundance):
+        """noise from the Weber fraction of the most abundant receptor and relative abundances (n,)"""
+        abundance = np.asarray(abundance, np.float64)
+        return cls(weber*np.sqrt(abundance.max()/abundance))
+
+    def distance(self, qa, qb):
+        """distance in JNDs between receptor catches qa (...,n) and qb (...,n), broadcast"""
+        tiny = np.finfo(np.float64).tiny
+        df = np.log(np.maximum(qa, tiny)) - np.log(np.maximum(qb, tiny))
+        return np.sqrt(np.maximum(np.einsum('...i,ij,...j->...', df, self.metric, df), 0))
+
+Series = namedtuple('Series', 'pwm jnd t reached')
+Series.__doc__ = """pwm : colours (M,5) at the requested distances, nan where they can't be reached
+jnd : achieved distance to the nearest distractor (M,), at the end of the path where not reached
+t : position along the path (M,), nan where not reached
+reached : (M,) True where the achieved distance is within tolerance of the requested one"""
+
+class JNDEvaluator:
+    """distances between panel colours, through a ColorEngine at fixed settings"""
+    def __init__(self, engine, noise, maxcurrent, brightness):
+        """
+        engine : color_engine.ColorEngine
+        noise : ReceptorNoise
+        maxcurrent, brightness : R,G,B,V codes of the panel settings
+        """
+        self.noise = noise
+        self.mixing = engine.mixing(maxcurrent, brightness)
+
+    def catches(self, pwm):
+        return np.asarray(pwm, np.float64) @ self.mixing.T
+
+    def jnd(self, candidates, distractors):
+        """distance of every candidate (...,5) to every distractor (D,5): (...,D)"""
+        qc = self.catches(candidates)[..., None, :]
+        qd = self.catches(distractors)
+        return self.noise.distance(qc, qd)
+
+    def nearest(self, candidates, distractors):
+        """distance of each candidate (...,5) to its nearest distractor: (...)"""
+        return self.jnd(candidates, distractors).min(-1)
+
+    def series(self, base, direction, jnds, distractors, iterations=48, tolerance=1e-3):
+        """pwm colours base + t*direction whose distance to the nearest distractor is each of jnds
+
+        Solved for all of jnds at once by bisection on t, within the range of t that keeps
+        the colour in [0,1]. Assumes the distance grows with t along the path.
+        Distances outside those reached within that range are masked rather than clamped.
+        tolerance : largest error in JNDs of a reached distance
+        returns Series
+        """
+        base = np.asarray(base, np.float64)
+        direction = np.asarray(direction, np.float64)
+        jnds = np.atleast_1d(np.asarray(jnds, np.float64))
+        #largest t that keeps base + t*direction within [0,1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            limit = np.where(direction > 0, (1 - base)/direction, np.where(direction < 0, -base/direction, np.inf))
+        t_max = limit.min()
+        if not np.isfinite(t_max):
+            raise ValueError('direction must be non-zero')
+        lo = np.zeros_like(jnds)
+        hi = np.full_like(jnds, t_max)
+        for i in range(iterations):
+            mid = (lo + hi)/2
+            d = self.nearest(base + mid[:, None]*direction, distractors)
+            below = d < jnds
+            lo = np.where(below, mid, lo)
+            hi = np.where(below, hi, mid)
+        t = (lo + hi)/2
+        pwm = base + t[:, None]*direction
+        achieved = self.nearest(pwm, distractors)
+        reached = np.abs(achieved - jnds) <= tolerance
+        t[~reached] = np.nan
+        pwm[~reached] = np.nan
+        return Series(pwm, achieved, t, reached)
@@ -143,7 +143,7 @@ with Serial(PORTNAME) as port:
         #load the max current, mode, brightness, dotcorrect, SPI frequency
         scpi.command('disp:load')
 
-        scpi.command(b'disp:pwm:all ' + scpi.format_bytes(img.tobytes()))
+        scpi.write_block(b'disp:pwm:all ', img)
         
         #turn on the display
         scpi.command(b'display on')
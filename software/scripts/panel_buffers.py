@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+"""
+Bit-exact model of the panel's LED driver buffers.
+
+The firmware (software/controller/src) keeps two buffers for the chain of 10
+TLC5955 chips: pwm_buffer, 96 bytes per chip holding 48 little-endian 16-bit PWM
+codes, and ctrl_buffer, 48 bytes per chip holding the control latch: 48 7-bit
+dot correct codes, 3 3-bit max current codes, 3 7-bit brightness codes and the
+5-bit function control (mode), packed LSB first at DC_OFFSET, MC_OFFSET,
+BC_OFFSET and FC_OFFSET, with the magic byte 0x96 last. Images are (8,12,5)
+row-major (y,x,c) and are mapped to LEDs through pixel_addr_lut.
+
+Everything here is vectorized: any function taking an image or buffer also takes
+a stack of them, with any number of leading dimensions.
+"""
+
+import numpy as np
+from collections import namedtuple
+
+PANEL_HEIGHT, PANEL_WIDTH, PANEL_CHANNELS = PANEL_DIMS = (8, 12, 5)
+PANEL_CHIPS = 10
+CHIP_LEDS = 48
+NUM_LEDS = PANEL_CHIPS * CHIP_LEDS
+PWM_BUFFER_SIZE = 2*CHIP_LEDS #bytes per chip
+CTRL_BUFFER_SIZE = 48 #bytes per chip
+RGB_CHIPS = (0, 2, 4, 5, 7, 9)
+UV_CHIPS = (1, 3, 6, 8)
+#R,G,B,V max current and brightness setting of each image channel R,G,B,V,UV:
+# DISP:MAXC and DISP:BRI set R,G,B,V, and UV shares V's settings
+RGBV_CHANNEL = [0, 1, 2, 3, 3]
+
+DC_BITS, MC_BITS, BC_BITS, FC_BITS = 7, 3, 7, 5
+def DC_OFFSET(led): return 8*CTRL_BUFFER_SIZE*(led // CHIP_LEDS) + DC_BITS*(led % CHIP_LEDS)
+def MC_OFFSET(c): return 336 + MC_BITS*c
+def BC_OFFSET(c): return 345 + BC_BITS*c
+FC_OFFSET = 366
+MAGIC = 0x96 #last byte of each chip's control buffer
+
+def pixel_addr_rgb(y, x, c):
+    """index of the RGB LED at (y,x,c) in the chain"""
+    cy, cx = y // 4, x // 4 #chip coordinates
+    y, x = y - 4*cy, x - 4*cx #pixel coordinates in the chip
+    return cy*(5*0x30) + cx*0x60 + y*12 + x*3 + c
+
+def pixel_addr_vuv(y, x, c):
+    """index of the V/UV LED at (y,x,c) in the chain. c = 0: V, 1: UV"""
+    lut = (0, 1, 3, 6, 7, 9, #V indices along the top row
+           2, 4, 5, 8, 10, 11) #UV indices along the top row
+    cy, cx = y // 4, x // 6
+    y, x = y - 4*cy, x - 6*cx
+    return cy*(5*0x30) + cx*0x60 + 0x30 + y*12 + lut[c*6 + x]
+
+def pixel_addr(y, x, c):
+    return pixel_addr_rgb(y, x, c) if c < 3 else pixel_addr_vuv(y, x, c-3)
+
+#LED index of each pixel of a row-major (y,x,c) image
+pixel_addr_lut = np.array([pixel_addr(y, x, c) for y in range(PANEL_HEIGHT)
+                                               for x in range(PANEL_WIDTH)
+                                               for c in range(PANEL_CHANNELS)], dtype=np.intp)
+#pixel index of each LED
+led_pixel_lut = np.argsort(pixel_addr_lut)
+
+def _leading(a, trailing):
+    """the leading (stack) shape of an array whose last dimensions are trailing"""
+    n = len(trailing)
+    if a.shape[a.ndim-n:] != tuple(trailing):
+        raise ValueError(f'expected an array of shape (...,{",".join(map(str,trailing))}), got {a.shape}')
+    return a.shape[:a.ndim-n]
+
+def _bits(codes, n):
+    """(..., k) codes -> (..., k*n) bits, LSB first"""
+    bits = (codes[..., None] >> np.arange(n, dtype=np.uint8)) & 1
+    return bits.reshape(codes.shape[:-1] + (-1,)).astype(np.uint8)
+
+def _codes(bits, offset, n, count, dtype=np.uint8):
+    """read count n-bit codes, LSB first, starting at bit offset of (..., bits)"""
+    b = bits[..., offset:offset+n*count].reshape(bits.shape[:-1] + (count, n))
+    return (b.astype(np.uint16) << np.arange(n, dtype=np.uint16)).sum(-1).astype(dtype)
+
+## PWM
+
+def pack_pwm(pwm, out=None):
+    """pwm_buffer bytes (..., 960) from pwm code images (..., 8, 12, 5)"""
+    pwm = np.asarray(pwm)
+    lead = _leading(pwm, PANEL_DIMS)
+    if out is None:
+        out = np.empty(lead + (PANEL_CHIPS*PWM_BUFFER_SIZE,), np.uint8)
+    words = out.view('<u2')
+    words[..., pixel_addr_lut] = pwm.reshape(lead + (NUM_LEDS,))
+    return out
+
+def unpack_pwm(buffer):
+    """pwm code images (..., 8, 12, 5) from pwm_buffer bytes (..., 960)"""
+    buffer = np.ascontiguousarray(np.asarray(buffer, np.uint8))
+    lead = _leading(buffer, (PANEL_CHIPS*PWM_BUFFER_SIZE,))
+    words = buffer.view('<u2')
+    return words[..., pixel_addr_lut].astype(np.uint16).reshape(lead + PANEL_DIMS)
+
+## control
+
+Control = namedtuple('Control', 'dotcorrect maxcurrent brightness mode magic')
+Control.__doc__ = """fields of ctrl_buffer: dotcorrect (..., 8, 12, 5), maxcurrent and
+brightness per chip and channel (..., 10, 3), mode and magic per chip (..., 10)"""
+
+def chip_codes(rgbv):
+    """per chip and channel codes (..., 10, 3) from R,G,B,V codes (..., 4), as DISP:MAXC and DISP:BRI set them"""
+    rgbv = np.asarray(rgbv)
+    lead = _leading(rgbv, (4,))
+    chips = np.empty(lead + (PANEL_CHIPS, 3), rgbv.dtype)
+    chips[..., RGB_CHIPS, :] = rgbv[..., None, :3]
+    chips[..., UV_CHIPS, :] = rgbv[..., None, 3:]
+    return chips
+
+def rgbv_codes(chips):
+    """R,G,B,V codes (..., 4) from per chip codes (..., 10, 3), as DISP:MAXC? and DISP:BRI? read them"""
+    chips = np.asarray(chips)
+    return np.concatenate([chips[..., RGB_CHIPS[0], :], chips[..., UV_CHIPS[0], :1]], -1)
+
+def _per_chip(codes):
+    codes = np.asarray(codes)
+    return chip_codes(codes) if codes.shape[-1:] == (4,) else codes
+
+def pack_ctrl(dotcorrect, maxcurrent, brightness, mode, out=None):
+    """ctrl_buffer bytes (..., 480)
+
+    dotcorrect : 7-bit code images (..., 8, 12, 5)
+    maxcurrent, brightness : R,G,B,V codes (..., 4) or per chip codes (..., 10, 3)
+    mode : 5-bit function control code, for all chips (...) or per chip (..., 10)
+    Codes are truncated to their bit width, as the firmware does.
+    """
+    dotcorrect = np.asarray(dotcorrect)
+    lead = _leading(dotcorrect, PANEL_DIMS)
+    leds = np.empty(lead + (NUM_LEDS,), np.uint8)
+    leds[..., pixel_addr_lut] = dotcorrect.reshape(lead + (NUM_LEDS,))
+    mc = np.broadcast_to(_per_chip(maxcurrent), lead + (PANEL_CHIPS, 3)).astype(np.uint8)
+    bc = np.broadcast_to(_per_chip(brightness), lead + (PANEL_CHIPS, 3)).astype(np.uint8)
+    mode = np.asarray(mode, np.uint8)
+    if mode.shape[-1:] != (PANEL_CHIPS,) or mode.ndim <= len(lead):
+        mode = mode[..., None]
+    fc = np.broadcast_to(mode, lead + (PANEL_CHIPS,))[..., None]
+    chip = lead + (PANEL_CHIPS,)
+    bits = np.concatenate([
+        _bits(leds.reshape(chip + (CHIP_LEDS,)), DC_BITS), #DC_OFFSET
+        _bits(mc, MC_BITS), #MC_OFFSET
+        _bits(bc, BC_BITS), #BC_OFFSET
+        _bits(fc, FC_BITS), #FC_OFFSET
+        np.zeros(chip + (8*(CTRL_BUFFER_SIZE-1) - FC_OFFSET - FC_BITS,), np.uint8),
+        _bits(np.full(chip + (1,), MAGIC, np.uint8), 8)], -1)
+    packed = np.packbits(bits, -1, bitorder='little').reshape(lead + (PANEL_CHIPS*CTRL_BUFFER_SIZE,))
+    if out is None: return packed
+    out[...] = packed
+    return out
+
+def unpack_ctrl(buffer):
+    """Control fields from ctrl_buffer bytes (..., 480)"""
+    buffer = np.asarray(buffer, np.uint8)
+    lead = _leading(buffer, (PANEL_CHIPS*CTRL_BUFFER_SIZE,))
+    bits = np.unpackbits(buffer.reshape(lead + (PANEL_CHIPS, CTRL_BUFFER_SIZE)), -1, bitorder='little')
+    leds = _codes(bits, 0, DC_BITS, CHIP_LEDS).reshape(lead + (NUM_LEDS,))
+    return Control(dotcorrect=leds[..., pixel_addr_lut].reshape(lead + PANEL_DIMS),
+                   maxcurrent=_codes(bits, MC_OFFSET(0), MC_BITS, 3),
+                   brightness=_codes(bits, BC_OFFSET(0), BC_BITS, 3),
+                   mode=_codes(bits, FC_OFFSET, FC_BITS, 1)[..., 0],
+                   magic=buffer.reshape(lead + (PANEL_CHIPS, CTRL_BUFFER_SIZE))[..., -1].copy())
+
+def set_dotcorrect(buffer, dotcorrect):
+    """write dot correct code images (..., 8, 12, 5) into ctrl_buffer bytes (..., 480) in place,
+    leaving the other fields as they are, as DISP:DOTC:ALL does"""
+    dotcorrect = np.asarray(dotcorrect)
+    lead = _leading(dotcorrect, PANEL_DIMS)
+    chips = buffer.reshape(lead + (PANEL_CHIPS, CTRL_BUFFER_SIZE))
+    bits = np.unpackbits(chips, -1, bitorder='little')
+    leds = np.empty(lead + (NUM_LEDS,), np.uint8)
+    leds[..., pixel_addr_lut] = dotcorrect.reshape(lead + (NUM_LEDS,))
+    bits[..., :DC_BITS*CHIP_LEDS] = _bits(leds.reshape(lead + (PANEL_CHIPS, CHIP_LEDS)), DC_BITS)
+    chips[...] = np.packbits(bits, -1, bitorder='little')
+    return buffer
+
+def get_dotcorrect(buffer):
+    """dot correct code images (..., 8, 12, 5) from ctrl_buffer bytes (..., 480)"""
+    return unpack_ctrl(buffer).dotcorrect
+
+## chip frames
+
+def chip_frames(buffer, ctrl=False):
+    """view a pwm (or ctrl) buffer (..., 960 or 480) as per chip frames (..., 10, 96 or 48)"""
+    size = CTRL_BUFFER_SIZE if ctrl else PWM_BUFFER_SIZE
+    buffer = np.asarray(buffer, np.uint8)
+    return buffer.reshape(buffer.shape[:-1] + (PANEL_CHIPS, size))
+
+def spi_bits(buffer, ctrl=False):
+    """the bits clocked into the chain by transfer_pwm (or transfer_control), in order
+
+    The last chip is sent first. Each chip gets 769 bits: the control flag, then its
+    frame MSB first with the bytes in reverse order. A control frame is sent as its
+    magic byte, 48 zero bytes, then the rest of the frame.
+    returns (..., 10*769) uint8 bits
+    """
+    frames = chip_frames(buffer, ctrl)
+    lead = frames.shape[:-2]
+    if ctrl:
+        pad = np.zeros(lead + (PANEL_CHIPS, CTRL_BUFFER_SIZE), np.uint8)
+        data = np.concatenate([frames[..., -1:], pad, frames[..., -2::-1]], -1)
+    else:
+        data = frames[..., ::-1]
+    flag = np.full(lead + (PANEL_CHIPS, 1), int(ctrl), np.uint8)
+    bits = np.concatenate([flag, np.unpackbits(data, -1)], -1)
+    return bits[..., ::-1, :].reshape(lead + (-1,))
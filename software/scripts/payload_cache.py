@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+"""
+Cache of the formatted messages of frames that are sent more than once.
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+from TLC5955 import TLC5955, SCPIProtocol
+
+class PayloadCache:
+    """recently used DISP:PWM:ALL messages, keyed by the frame
+    
+    A frame that repeats (blank and alignment frames, a layout at a few colours) is
+    only encoded and formatted the first time. After that its message is one
+    dictionary lookup, keyed by the frame's bytes. At most capacity messages (and max_bytes, if
+    given) are kept, the least recently used are dropped first.
+    encode : encode(frame) to PWM codes, eg. TLC5955.pwm_code or response_lut.ResponseLUT.pwm_code
+    The config given with each frame is part of the key: pass anything hashable
+    that changes when encode's result would, eg. the config file name.
+    """
+    def __init__(self, encode=None, capacity=256, max_bytes=None, prefix=b':disp:pwm:all ', suffix=b';:disp:refr'):
+        self.encode = TLC5955.pwm_code if encode is None else encode
+        self.capacity = capacity
+        self.max_bytes = max_bytes
+        self.prefix = prefix
+        self.suffix = suffix
+        self.response = SCPIProtocol.expects_response(prefix + suffix)
+        self._entries = OrderedDict() #key -> message
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0 #of the cached frames and messages
+
+    @staticmethod
+    def key(frame, config=None):
+        #the frame's bytes, so that the dict hashes them and a hit is an exact match.
+        #hashing 3840 bytes is faster here than any hashlib digest of them
+        frame = np.asarray(frame)
+        return (frame.dtype.char, frame.shape, frame.tobytes(), config)
+
+    def message(self, frame, config=None):
+        """the complete message for frame, ready for SCPIProtocol.submit"""
+        key = self.key(frame, config)
+        with self._lock:
+            msg = self._entries.get(key)
+            if msg is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return msg
+            self.misses += 1
+        codes = np.ascontiguousarray(self.encode(frame), '<u2')
+        n = str(codes.nbytes)
+        msg = b''.join((self.prefix, bytes(f'#{len(n)}{n}', 'utf-8'), codes.tobytes(), self.suffix))
+        with self._lock:
+            if key not in self._entries:
+                self._entries[key] = msg
+                self.nbytes += len(key[2]) + len(msg)
+                while self._entries and (len(self._entries) > self.capacity or
+                                         (self.max_bytes is not None and self.nbytes > self.max_bytes)):
+                    old_key, old_msg = self._entries.popitem(last=False)
+                    self.nbytes -= len(old_key[2]) + len(old_msg)
+                    self.evictions += 1
+        return msg
+
+    def send(self, scpi, frame, config=None):
+        """send frame through scpi (SCPIProtocol or AsyncSCPIProtocol), returns the Future of submit"""
+        return scpi.submit(self.message(frame, config), self.response)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def info(self):
+        """hit and miss counters and memory use"""
+        total = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hits/total if total else float('nan'),
+                'entries': len(self._entries), 'nbytes': self.nbytes}
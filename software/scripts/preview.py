@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+Live previews of the panel for the operator, on matplotlib axes or a Tk canvas.
+
+The hex grid (as nemo_testing.draw_pattern draws it) is built once. After that
+a frame only changes face colours: MplPreview redraws its one PolyCollection by
+blitting, and TkPreview calls itemconfig on the polygons whose colour changed.
+
+The sending loop never waits for the display. show() (or passing preview.show as
+the monitor of SCPIProtocol.stream) only keeps a reference to the newest frame,
+and the GUI draws whichever frame is newest on its own timer, so a preview keeps
+up with any frame rate by skipping the frames it has no time to draw.
+
+GUI toolkits must only be used from their own thread: create the preview and
+run the GUI's main loop in one thread, and send from another.
+"""
+
+import abc
+import numpy as np
+from trials import hex_positions
+from panel_buffers import PANEL_DIMS
+
+#display colour of each channel R,G,B,V,UV at full PWM. V and UV are shown as violet and magenta
+CHANNEL_RGB = np.array([[1.0, 0.0, 0.0],
+                        [0.0, 1.0, 0.0],
+                        [0.0, 0.0, 1.0],
+                        [0.5, 0.0, 1.0],
+                        [1.0, 0.0, 1.0]])
+
+HEX_RADIUS = 0.9/np.sqrt(3)
+
+def hex_vertices(radius=HEX_RADIUS):
+    """corners (96,6,2) of each pixel's hexagon, flat sides up and down as in draw_pattern"""
+    angle = np.arange(6)*np.pi/3
+    corners = radius*np.stack([np.cos(angle), np.sin(angle)], -1)
+    return hex_positions()[:, None] + corners
+
+class Preview(abc.ABC):
+    """the newest frame and its display colours. Subclasses draw them"""
+    def __init__(self, gain=1.0, gamma=1/2.2, channel_rgb=CHANNEL_RGB):
+        """
+        gain : multiplies pwm fractions before display, scalar or per channel (5,), eg. to see UV
+        gamma : display gamma applied to the mixed colour
+        """
+        gain = np.broadcast_to(np.asarray(gain, np.float64), (PANEL_DIMS[-1],))
+        self.mixing = gain[:, None] * np.asarray(channel_rgb, np.float64) #(5,3)
+        self.gamma = gamma
+        self._frame = None
+        self._drawn = 0 #the value of received when the drawn frame was shown
+        self.received = 0 #frames given to show()
+        self.drawn = 0 #frames drawn
+
+    def show(self, frame):
+        """mirror frame (8,12,5), pwm codes or fractions. returns at once, from any thread"""
+        self._frame = frame #reference assignments are atomic, so no lock is needed
+        self.received += 1
+
+    def colors(self, frame):
+        """display colours (96,3) in [0,1] of frame"""
+        frame = np.asarray(frame)
+        scale = 1/65535 if frame.dtype.kind in 'ui' else 1.0
+        rgb = frame.reshape(-1, PANEL_DIMS[-1]) @ (self.mixing*scale)
+        np.clip(rgb, 0, 1, out=rgb)
+        return np.power(rgb, self.gamma, out=rgb)
+
+    def update(self):
+        """draw the newest frame if it is not drawn yet. returns True if it drew"""
+        received, frame = self.received, self._frame
+        if received == self._drawn:
+            return False
+        self._drawn = received
+        self._draw(self.colors(frame))
+        self.drawn += 1
+        return True
+
+    @abc.abstractmethod
+    def _draw(self, colors):
+        """draw display colours (96,3)"""
+
+class MplPreview(Preview):
+    """preview on matplotlib axes, redrawn by blitting"""
+    def __init__(self, ax, interval=10, **kw):
+        """ax : axes to draw on. interval : ms between checks for a new frame"""
+        from matplotlib.collections import PolyCollection
+        super().__init__(**kw)
+        self.ax = ax
+        self.hexes = PolyCollection(hex_vertices(), facecolors='black', edgecolors='none', animated=True)
+        ax.add_collection(self.hexes, autolim=False)
+        xy = hex_vertices().reshape(-1, 2)
+        ax.set_xlim(xy[:, 0].min(), xy[:, 0].max())
+        ax.set_ylim(xy[:, 1].max(), xy[:, 1].min()) #row 0 at the top
+        ax.set_aspect('equal')
+        ax.set_axis_off()
+        self.canvas = ax.figure.canvas
+        self._background = None
+        self.canvas.mpl_connect('draw_event', self._on_draw)
+        self.timer = self.canvas.new_timer(interval=interval)
+        self.timer.add_callback(self.update)
+        self.timer.start()
+
+    def _on_draw(self, event):
+        #a full redraw (eg. on resize): save the background without the hexes, then draw them over it
+        self._background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.hexes)
+
+    def _draw(self, colors):
+        self.hexes.set_facecolor(colors)
+        if self._background is None: #not drawn yet
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self._background)
+        self.ax.draw_artist(self.hexes)
+        self.canvas.blit(self.ax.bbox)
+
+#'#rrggbb' of every byte, for Tk colour strings
+_HEX = np.array([f'{i:02x}' for i in range(256)], dtype=object)
+
+class TkPreview(Preview):
+    """preview on a Tk canvas, updating only the polygons whose colour changed"""
+    def __init__(self, parent, scale=30, interval=10, **kw):
+        """parent : Tk widget to put the canvas in. scale : pixels per pixel pitch. interval : ms between checks for a new frame"""
+        from tkinter import Canvas
+        super().__init__(**kw)
+        xy = hex_vertices()*scale
+        xy -= xy.reshape(-1, 2).min(0)
+        width, height = xy.reshape(-1, 2).max(0)
+        self.canvas = Canvas(parent, width=width, height=height, background='black', highlightthickness=0)
+        self.items = [self.canvas.create_polygon(*p.ravel(), fill='#000000', outline='') for p in xy]
+        self._fills = np.full(len(self.items), '#000000', dtype=object)
+        self.interval = interval
+        self._poll()
+
+    def _poll(self):
+        self.update()
+        self.canvas.after(self.interval, self._poll)
+
+    def _draw(self, colors):
+        b = (colors*255 + 0.5).astype(np.uint8)
+        fills = '#' + _HEX[b[:, 0]] + _HEX[b[:, 1]] + _HEX[b[:, 2]]
+        for i in np.flatnonzero(fills != self._fills):
+            self.canvas.itemconfig(self.items[i], fill=fills[i])
+        self._fills = fills
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""
+Replay a recorded session (session_log) to a panel or the emulator.
+
+The frames and display on/off events of a log are sent again in order, either at
+their recorded times (scaled by speed) or as fast as the link allows, to reproduce
+a subject's exact stimulus sequence or to compare throughput between versions of
+the transport. Responses and other records are not sent.
+
+    python replay.py session.log                     replay to the emulator in real time
+    python replay.py session.log --fast              as fast as possible
+    python replay.py session.log --port /dev/ttyACM0 to a panel
+
+The report gives, for every record sent, its lateness against the schedule and the
+error of the interval since the previous one against the recorded interval, and
+lists the records that the panel reported an error for.
+"""
+
+import time
+import argparse
+import numpy as np
+from TLC5955 import SCPIProtocol, StreamReport
+import session_log
+
+class ReplayReport(StreamReport):
+    """timing of a replay. index and failed count the replayed records in order
+    
+    records : index in the records given to replay() of each replayed record
+    recorded : their logged times
+    """
+    def __init__(self, speed, tolerance, records, recorded):
+        super().__init__(None, tolerance)
+        self.speed = speed
+        self.records = records
+        self.recorded = recorded
+
+    @property
+    def interval_error(self):
+        """seconds each interval between sends differed from the recorded one (scaled by speed), first is 0"""
+        sent, recorded = self.sent, self.recorded[self.index]
+        if len(sent) == 0: return sent
+        speed = self.speed or np.inf #as fast as possible: the ideal interval is 0
+        return np.concatenate([[0.0], np.diff(sent) - np.diff(recorded)/speed])
+
+    def __repr__(self):
+        mode = 'as fast as possible' if self.speed is None else f'at {self.speed}x'
+        return (f'ReplayReport({len(self.index)} sent {mode}, {len(self.late)} late, {len(self.failed)} failed, {self.achieved_fps:.2f} sends/s, '
+                f'max interval error {np.max(np.abs(self.interval_error), initial=0)*1e3:.2f} ms)')
+
+def replay(scpi, records, session=None, speed=1.0, window=4, uploader=None, tolerance=1e-3, timeout=5, monitor=None):
+    """send the FRAME, DISPLAY_ON and DISPLAY_OFF records of a log again, through SCPIProtocol.stream
+
+    scpi : a started SCPIProtocol
+    records : log records, eg. session_log.read(path)[1] or a slice of it
+    session : trials.Session, for logs that refer to its frames rather than storing them
+    speed : replay speed relative to the recording, None for as fast as possible
+    window, uploader, tolerance, timeout, monitor : as SCPIProtocol.stream
+    returns a ReplayReport
+    """
+    kinds = records['kind']
+    index = np.flatnonzero(np.isin(kinds, (session_log.FRAME, session_log.DISPLAY_ON, session_log.DISPLAY_OFF)))
+    has_frames = 'pwm' in records.dtype.names
+    if not has_frames and session is None and np.any(kinds[index] == session_log.FRAME):
+        raise ValueError('this log has no frames: a session is needed')
+    commands = {session_log.DISPLAY_ON: b':disp on', session_log.DISPLAY_OFF: b':disp off'}
+    times = np.asarray(records['time'][index])
+    def items():
+        for i in index:
+            record = records[i]
+            if record['kind'] != session_log.FRAME:
+                yield commands[record['kind']]
+            elif has_frames:
+                yield record['pwm']
+            else:
+                yield session.pwm(record['ref'])
+    report = ReplayReport(speed, tolerance, index, times)
+    due = None if speed is None or len(times) == 0 else (times - times[0])/speed
+    return scpi.stream(items(), window=window, drop_late=False, tolerance=tolerance, timeout=timeout,
+                       uploader=uploader, monitor=monitor, times=due, report=report)
+
+if __name__ == '__main__':
+    from contextlib import ExitStack
+    from serial import Serial
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('log', help='session log file')
+    parser.add_argument('--session', help='session file, for logs without frames (default: as recorded in the log)')
+    parser.add_argument('--port', help='serial port of the panel (default: an emulated panel)')
+    parser.add_argument('--fast', action='store_true', help='send as fast as possible')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed relative to the recording')
+    parser.add_argument('--start', type=int, default=0, help='first record to replay')
+    parser.add_argument('--stop', type=int, default=None, help='record to stop before')
+    args = parser.parse_args()
+
+    header, records = session_log.read(args.log)
+    session = None
+    if not header['frames']:
+        from trials import Session
+        session = Session(args.session or header['session'])
+    with ExitStack() as stack:
+        port = args.port
+        if port is None:
+            from emulator import PtyPanel
+            port = stack.enter_context(PtyPanel()).port
+        scpi = stack.enter_context(SCPIProtocol(stack.enter_context(Serial(port))))
+        scpi.command(b'syst:comm:echo off')
+        time.sleep(0.1)
+        scpi.resync().result(5) #discard the echo
+        report = replay(scpi, records[args.start:args.stop], session, None if args.fast else args.speed)
+    print(report)
+    lateness, error = report.lateness*1e3, report.interval_error*1e3
+    for name, x in (('lateness', lateness), ('interval error', error)):
+        if len(x):
+            print(f'{name:15} ms: median {np.median(x):.3f}, 99% {np.percentile(np.abs(x), 99):.3f}, max {np.abs(x).max():.3f}')
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Per LED inverse response tables: light output to PWM code.
+
+TLC5955.pwm_code assumes each LED's output is linear in its PWM duty cycle.
+A ResponseLUT replaces that with a measured inverse for every pixel and
+channel: the PWM code that gives each of K evenly spaced fractions of the
+LED's full output. The levels are shared by every LED, so a lookup is an index
+computation and a linear interpolation between two codes, for a whole stack of
+frames at once, with no search.
+
+The tables are (8,12,5,K) uint16, 31 kB for K = 33, and are saved in the panel
+config (see test_panel.py) as the response_codes array. load() keeps the
+compiled tables of each config file, so reloading a config is free.
+"""
+
+import os
+import numpy as np
+from panel_buffers import PANEL_DIMS
+
+class ResponseLUT:
+    def __init__(self, codes):
+        """codes : PWM codes (8,12,5,K) giving output fractions linspace(0, 1, K) of each LED"""
+        codes = np.asarray(codes, np.uint16)
+        if codes.shape[:-1] != PANEL_DIMS or codes.shape[-1] < 2:
+            raise ValueError(f'expected codes of shape (8,12,5,K), K >= 2, got {codes.shape}')
+        self.codes = codes
+        self.levels = np.linspace(0, 1, codes.shape[-1])
+        #compiled: code = base[i] + slope[i]*f for segment i of each LED, flattened for np.take
+        k = codes.shape[-1]
+        flat = codes.reshape(-1, k).astype(np.float64)
+        self._base = np.ascontiguousarray(flat[:, :-1]).ravel()
+        self._slope = np.diff(flat, axis=-1).ravel()
+        self._offset = (np.arange(flat.shape[0])*(k-1)).reshape(PANEL_DIMS)
+        self._scratch = {} #shape -> (float64, intp) work arrays
+
+    @classmethod
+    def linear(cls, k=2):
+        """the tables TLC5955.pwm_code assumes"""
+        codes = np.round(np.linspace(0, 65535, k)).astype(np.uint16)
+        return cls(np.broadcast_to(codes, PANEL_DIMS + (k,)))
+
+    @classmethod
+    def from_measurements(cls, pwm, output, k=33):
+        """invert measured responses
+
+        pwm : PWM codes (M,) that were measured, increasing
+        output : light output (8,12,5,M) of each LED at each code, any units
+        Each LED's output is normalised to its largest and made non-decreasing (by its
+        running maximum) before it is inverted by linear interpolation.
+        """
+        pwm = np.asarray(pwm, np.float64)
+        output = np.maximum.accumulate(np.asarray(output, np.float64), axis=-1)
+        top = output[..., -1:]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            output = np.where(top > 0, output/top, 0.0)
+        levels = np.linspace(0, 1, k)
+        #segment of each level in each LED's response, all LEDs at once
+        j = (output[..., None, :] < levels[:, None]).sum(-1) #(8,12,5,k)
+        j = np.clip(j, 1, len(pwm) - 1)
+        y0 = np.take_along_axis(output, j - 1, -1)
+        y1 = np.take_along_axis(output, j, -1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            f = np.clip(np.where(y1 > y0, (levels - y0)/(y1 - y0), 0.0), 0, 1)
+        codes = pwm[j-1] + f*(pwm[j] - pwm[j-1])
+        return cls(np.clip(np.round(codes), 0, 65535))
+
+    def _work(self, shape):
+        work = self._scratch.get(shape)
+        if work is None:
+            work = self._scratch[shape] = (np.empty(shape, np.float64), np.empty(shape, np.intp))
+        return work
+
+    def pwm_code(self, img, out=None):
+        """PWM codes (...,8,12,5) for output fractions img (...,8,12,5), in place of TLC5955.pwm_code"""
+        shape = np.shape(img)
+        t, i = self._work(shape)
+        k = self.codes.shape[-1]
+        np.clip(img, 0.0, 1.0, out=t)
+        t *= k - 1
+        np.copyto(i, t, casting='unsafe') #t >= 0, so this is floor
+        np.minimum(i, k - 2, out=i)
+        t -= i #the fraction along segment i
+        i += self._offset
+        t *= self._slope.take(i)
+        t += self._base.take(i)
+        t += 0.5
+        np.floor(t, out=t)
+        if out is None:
+            out = np.empty(shape, np.uint16)
+        np.copyto(out, t, casting='unsafe')
+        return out
+
+    def to_config(self):
+        """arrays to save with the panel config"""
+        return {'response_codes': self.codes}
+
+    @classmethod
+    def from_config(cls, cfg):
+        """tables from a loaded panel config (a mapping of arrays), or None if it has none"""
+        if 'response_codes' not in cfg: return None
+        return cls(cfg['response_codes'])
+
+_loaded = {} #(path, mtime) -> ResponseLUT or None
+
+def load(config_file):
+    """the tables saved in a panel config file (.npz), or None. compiled once per version of the file"""
+    key = (os.path.abspath(config_file), os.path.getmtime(config_file))
+    if key not in _loaded:
+        with np.load(config_file) as cfg:
+            _loaded[key] = ResponseLUT.from_config(cfg)
+    return _loaded[key]
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+"""
+Timed presentation of precomputed trials, with response capture.
+
+SessionRunner plays a sequence of frames (eg. a trials.Session) on the panel
+through an AsyncSCPIProtocol. Each trial's frame is uploaded during the
+inter-trial interval, the display is turned on when the trial is due, and off
+again at the first response or after the trial duration. The next trial is due
+iti seconds after the display went off.
+
+Everything is timestamped with time.monotonic(): when each command was written,
+when the panel acknowledged it, and when each response arrived. Onsets are
+scheduled by sleeping on the event loop and spinning for the last few ms, and the
+lateness of each onset (its jitter) is recorded with the trial.
+
+Responses come from KeyboardResponses (keys pressed in the terminal, POSIX) or
+from anything that calls SessionRunner.respond, which may be called from any
+thread, eg. a Tk button or a response box callback.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import numpy as np
+from TLC5955 import SCPICommandError, async_sleep_until
+from panel_buffers import PANEL_DIMS
+
+RESULT_DTYPE = np.dtype([('trial', np.int32),
+                         ('due', np.float64), #when the display was due to turn on
+                         ('on_sent', np.float64), #when DISP ON was written
+                         ('on_acked', np.float64), #when the panel acknowledged it
+                         ('off_sent', np.float64),
+                         ('off_acked', np.float64),
+                         ('response', 'U16'), #first response during the trial, '' for none
+                         ('response_time', np.float64), #when it arrived, nan for none
+                         ('jitter', np.float64), #on_sent - due
+                         ('failed', np.bool_)]) #the panel reported an error for the trial's frame or commands
+
+class SessionRunner:
+    DISPLAY_ON = b':disp on'
+    DISPLAY_OFF = b':disp off'
+
+    def __init__(self, scpi, frames, iti, duration=None, end_on_response=True, on_event=None, spin=2e-3):
+        """
+        scpi : a started AsyncSCPIProtocol
+        frames : pwm codes (N,8,12,5) uint16, or a trials.Session
+        iti : seconds from the display turning off to the next trial
+        duration : most seconds the display stays on, None to wait for a response
+        end_on_response : turn the display off at the first response
+        on_event : called as on_event(kind, trial, t, value) for kind 'frame' (value is the frame),
+                   'on', 'off' and 'response' (value is the key), eg. session_log.SessionLog.on_event
+        """
+        if duration is None and not end_on_response:
+            raise ValueError('a trial without a duration must end on a response')
+        self.scpi = scpi
+        self.frames = self._pwm_frames(frames)
+        self.iti = iti
+        self.duration = duration
+        self.end_on_response = end_on_response
+        self.on_event = on_event
+        self.spin = spin
+        self.results = np.zeros(len(self.frames), RESULT_DTYPE)
+        self._loop = None
+        self._responses = None
+        self._stopping = False
+
+    @staticmethod
+    def _pwm_frames(frames):
+        """the pwm codes (N,8,12,5) of frames, a view of a trials.Session's"""
+        trials = getattr(frames, 'trials', None)
+        if trials is not None and trials.dtype.names and 'pwm' in trials.dtype.names:
+            frames = trials['pwm']
+        frames = np.asarray(frames)
+        if frames.ndim != 4 or frames.shape[1:] != PANEL_DIMS or frames.dtype != np.uint16:
+            raise ValueError(f'frames must be uint16 pwm codes (N,8,12,5), got {frames.dtype} {frames.shape}')
+        return frames
+
+    def respond(self, key, t=None):
+        """record a response, from any thread. t : when it happened (time.monotonic()), default now"""
+        if t is None: t = time.monotonic()
+        self._loop.call_soon_threadsafe(self._responses.put_nowait, (str(key), t))
+
+    def stop(self):
+        """finish after the current trial"""
+        self._stopping = True
+
+    def _event(self, kind, trial, t, value=None):
+        if self.on_event is not None:
+            self.on_event(kind, trial, t, value)
+
+    async def _acked(self, f):
+        """wait for a checked acknowledgement, returns False if the panel reported an error"""
+        try:
+            await self.scpi.result(f)
+        except SCPICommandError:
+            return False
+        return True
+
+    async def _command(self, command):
+        """write command with an acknowledgement: returns when it was written, when it was
+        acknowledged, and False if the panel reported an error"""
+        f = self.scpi.checked(self.scpi.submit(command + b';' + self.scpi.ACK, True))
+        sent = time.monotonic()
+        ok = await self._acked(f)
+        return sent, time.monotonic(), ok
+
+    async def _response(self, deadline):
+        """the first response before deadline (None for no deadline), or None"""
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            return await asyncio.wait_for(self._responses.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def _trial(self, i, due):
+        r = self.results[i]
+        r['trial'] = i
+        r['due'] = due
+        frame = self.frames[i]
+        upload = self.scpi.checked(self.scpi.write_block(b':disp:pwm:all ', frame, b';:disp:refr;' + self.scpi.ACK, True))
+        self._event('frame', i, time.monotonic(), frame)
+        ok = await self._acked(upload)
+        await async_sleep_until(due, self.spin)
+        r['on_sent'], r['on_acked'], on_ok = await self._command(self.DISPLAY_ON)
+        r['jitter'] = r['on_sent'] - due
+        self._event('on', i, r['on_sent'])
+        deadline = None if self.duration is None else r['on_sent'] + self.duration
+        r['response_time'] = np.nan
+        while True:
+            response = await self._response(deadline)
+            if response is None: break #out of time
+            key, t = response
+            if t < r['on_sent']: continue #pressed during the interval
+            self._event('response', i, t, key)
+            if not r['response']:
+                r['response'], r['response_time'] = key, t
+            if self.end_on_response: break
+        if deadline is not None and response is None:
+            await async_sleep_until(deadline, self.spin)
+        r['off_sent'], r['off_acked'], off_ok = await self._command(self.DISPLAY_OFF)
+        r['failed'] = not (ok and on_ok and off_ok)
+        self._event('off', i, r['off_sent'])
+
+    async def run(self, delay=0.5):
+        """play every trial, the first delay seconds from now. returns the results (trials,) RESULT_DTYPE"""
+        if self._loop is None:
+            self.attach()
+        if not (await self._command(self.DISPLAY_OFF))[2]:
+            raise SCPICommandError('the panel did not turn the display off')
+        due = time.monotonic() + delay
+        for i in range(len(self.frames)):
+            if self._stopping:
+                return self.results[:i]
+            await self._trial(i, due)
+            due = self.results[i]['off_sent'] + self.iti
+        return self.results
+
+    def attach(self, loop=None):
+        """make respond() usable before run() is awaited"""
+        self._loop = loop or asyncio.get_running_loop()
+        self._responses = asyncio.Queue()
+
+def jitter_summary(results):
+    """median, 99th percentile and largest onset lateness, in ms"""
+    j = results['jitter']*1e3
+    return {'median': float(np.median(j)), 'p99': float(np.percentile(j, 99)), 'max': float(j.max())}
+
+class KeyboardResponses:
+    """keys pressed in the terminal as responses, read on the event loop (POSIX)
+
+    The terminal is put in cbreak mode, so keys arrive without Enter.
+    keys : the keys to accept, or None for any
+    """
+    def __init__(self, runner, keys=None):
+        self.runner = runner
+        self.keys = keys
+        self._fd = sys.stdin.fileno()
+        self._attrs = None
+
+    def __enter__(self):
+        import termios, tty
+        self._attrs = termios.tcgetattr(self._fd)
+        tty.setcbreak(self._fd)
+        asyncio.get_running_loop().add_reader(self._fd, self._read)
+        return self
+
+    def __exit__(self, *exc):
+        import termios
+        asyncio.get_running_loop().remove_reader(self._fd)
+        termios.tcsetattr(self._fd, termios.TCSADRAIN, self._attrs)
+
+    def _read(self):
+        t = time.monotonic()
+        for key in os.read(self._fd, 64).decode(errors='replace'):
+            if self.keys is None or key in self.keys:
+                self.runner.respond(key, t)
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+"""
+Append-only binary log of what was sent to the panel.
+
+A log file is a 512 byte header, the magic bytes then JSON padded with spaces,
+followed by fixed size little-endian records:
+
+    time   float64  time.monotonic() of the event
+    kind   uint32   FRAME, DISPLAY_ON, DISPLAY_OFF, RESPONSE or COMMAND
+    ref    int32    trial index in the session file, -1 for none
+    value  int32    response key (its code point), otherwise 0
+    pwm    uint16 (8,12,5)  the frame sent, only in logs made with frames=True
+
+Records are written through a large buffer, so logging a frame is a copy into
+memory. read() maps the records with np.memmap, so analysis only touches the
+pages of the slice it uses. A record cut short at the end of the file (eg. by a
+crash) is ignored.
+
+Logs without frames are 20 bytes a record and refer to the frames of a session
+file (trials.Session) by trial index. frames() looks them up.
+"""
+
+import os
+import json
+import time
+import threading
+import numpy as np
+from panel_buffers import PANEL_DIMS
+
+MAGIC = b'UVTVLOG\0'
+HEADER_SIZE = 512
+VERSION = 1
+
+FRAME, DISPLAY_ON, DISPLAY_OFF, RESPONSE, COMMAND = range(5)
+KINDS = {'frame': FRAME, 'on': DISPLAY_ON, 'off': DISPLAY_OFF, 'response': RESPONSE, 'command': COMMAND}
+
+def record_dtype(frames):
+    fields = [('time', '<f8'), ('kind', '<u4'), ('ref', '<i4'), ('value', '<i4')]
+    if frames:
+        fields.append(('pwm', '<u2', PANEL_DIMS))
+    return np.dtype(fields)
+
+class SessionLog:
+    """writes a log. Safe to use from several threads"""
+    def __init__(self, path, frames=True, session=None, buffer_size=1 << 20):
+        """
+        path : log file, appended to if it exists (with the settings it was made with)
+        frames : store each frame sent. Without, frames are only referred to by trial index
+        session : path of the session file the trial indices refer to
+        """
+        if os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE:
+            self.header = read_header(path)
+        else:
+            self.header = {'version': VERSION, 'frames': frames, 'session': session, 'clock': 'time.monotonic'}
+            with open(path, 'wb') as f:
+                f.write(_format_header(self.header))
+        self.dtype = record_dtype(self.header['frames'])
+        #records that were cut short by a crash are overwritten
+        whole = (os.path.getsize(path) - HEADER_SIZE) // self.dtype.itemsize
+        self._file = open(path, 'r+b', buffering=buffer_size)
+        self._file.truncate(HEADER_SIZE + whole*self.dtype.itemsize)
+        self._file.seek(0, os.SEEK_END)
+        self._record = np.zeros(1, self.dtype)
+        self._lock = threading.Lock()
+        self.records = whole
+
+    def log(self, kind, t=None, ref=-1, value=0, pwm=None):
+        """append a record. t defaults to now. pwm : pwm codes (8,12,5) of a FRAME"""
+        if t is None: t = time.monotonic()
+        with self._lock:
+            r = self._record
+            r['time'], r['kind'], r['ref'], r['value'] = t, kind, ref, value
+            if 'pwm' in self.dtype.names:
+                if pwm is None: r['pwm'] = 0
+                else: r['pwm'][0] = pwm
+            elif pwm is not None and ref < 0:
+                raise ValueError('this log has no frames: a frame must refer to a session trial')
+            self._file.write(r.data)
+            self.records += 1
+
+    def frame(self, pwm, ref=-1, t=None):
+        """log a frame sent. Usable as the monitor of SCPIProtocol.stream
+        
+        A log without frames can't store one that isn't a session trial, so it is skipped.
+        """
+        if ref < 0 and 'pwm' not in self.dtype.names:
+            return
+        self.log(FRAME, t, ref, 0, pwm)
+
+    def on_event(self, kind, trial, t, value=None):
+        """log an event of runner.SessionRunner: use as its on_event"""
+        if kind == 'frame':
+            self.log(FRAME, t, trial, 0, value)
+        elif kind == 'response':
+            self.log(RESPONSE, t, trial, ord(value[0]) if value else 0)
+        else:
+            self.log(KINDS[kind], t, trial)
+
+    def flush(self):
+        with self._lock:
+            self._file.flush()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def _format_header(header):
+    text = json.dumps(header).encode()
+    if len(MAGIC) + len(text) > HEADER_SIZE:
+        raise ValueError('log header is too long')
+    return MAGIC + text.ljust(HEADER_SIZE - len(MAGIC))
+
+def read_header(path):
+    with open(path, 'rb') as f:
+        data = f.read(HEADER_SIZE)
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not a session log')
+    return json.loads(data[len(MAGIC):])
+
+def read(path):
+    """the header and the records of a log, memory mapped read only: (dict, np.memmap (N,))"""
+    header = read_header(path)
+    dtype = record_dtype(header['frames'])
+    n = (os.path.getsize(path) - HEADER_SIZE) // dtype.itemsize
+    if n == 0:
+        return header, np.zeros(0, dtype)
+    return header, np.memmap(path, dtype, 'r', HEADER_SIZE, (n,))
+
+def frames(records, session=None):
+    """the pwm codes (M,8,12,5) of the FRAME records in records (eg. a slice of read()[1])
+
+    Frames that are not in the log are taken from session (trials.Session) by trial index.
+    """
+    records = records[records['kind'] == FRAME]
+    if 'pwm' in records.dtype.names:
+        return np.array(records['pwm'])
+    if session is None:
+        raise ValueError('this log has no frames: a session is needed')
+    return session.trials['pwm'][records['ref']]
@@ -11,6 +11,7 @@ from tkinter import Tk, messagebox
 from serial import Serial
 from serial.tools.list_ports import comports
 from TLC5955 import SCPIProtocol, SCPIException, TLC5955
+import response_lut
 
 ## Set PORTNAME = None to auto-detect
 PORTNAME = None
@@ -40,6 +41,8 @@ class config:
     dotcorrect = np.ones((8,12,5))
     # SPI frequency, in Hz. Should be 3000000  (3 MHz)
     spif = 3000000
+    # measured inverse LED responses (response_lut.ResponseLUT). None if the LEDs are taken to be linear
+    response = None
 
 all_modes = ('reset','test','test-board','upload','download')
 
@@ -68,6 +71,8 @@ def save_config(config_file):
     if os.path.exists(config_file):
         raise RuntimeError(f'Error saving {config_file}: file already exists!')
     items = {name:value for name,value in vars(config).items() if not name.startswith('_')} #get the "public" members of config
+    response = items.pop('response')
+    if response is not None: items.update(response.to_config())
     config_path = os.path.split(config_file)[0]
     if config_path: os.makedirs(config_path, exist_ok=True)
     np.savez(config_file, **items)
@@ -81,6 +86,7 @@ def load_config(config_file):
         config.brightness = cfg['brightness']
         config.dotcorrect = cfg['dotcorrect']
         config.spif = cfg['spif']
+    config.response = response_lut.load(config_file)
 
 def upload_config(scpi, save=False):
     """upload config settings to board, if save==True, also save to board's internal storage"""
@@ -88,22 +94,20 @@ def upload_config(scpi, save=False):
     mc_codes = ','.join(f'{TLC5955.maxcurrent_code(mc)}' for mc in config.maxcurrent)
     bc_codes = ','.join(f'{TLC5955.brightness_code(bc)}' for bc in config.brightness)
     dc_codes = scpi.format_bytes(TLC5955.dotcorrect_code(config.dotcorrect).tobytes())
-    scpi.command(f'disp:spif {config.spif}', True)
-    scpi.command(f'disp:mode {mode_code}')
-    scpi.command(f'disp:maxc {mc_codes}')
-    scpi.command(f'disp:bri {bc_codes}')
-    scpi.command(f'disp:dotc:all {dc_codes}')
+    commands = [(f'disp:spif {config.spif}', True), #responds with the actual frequency
+                f'disp:mode {mode_code}',
+                f'disp:maxc {mc_codes}',
+                f'disp:bri {bc_codes}',
+                b'disp:dotc:all ' + dc_codes]
     if save:
-        scpi.command('disp:save')
+        commands.append('disp:save')
+    #sent as one compound message, which waits until the board has processed all of it
+    scpi.batch(commands)
 
 def download_config(scpi):
-    serial = scpi.command(b'syst:serial?',True)[0]
-    spif = scpi.command(b'disp:spif?',True)[0]
-    mode_code = scpi.command(b'disp:mode?',True)[0]
-    mc_codes = scpi.command(b'disp:maxc?',True)
-    bc_codes = scpi.command(b'disp:bri?',True)
-    dc_bytes = scpi.command(b'disp:dotc:all?',True)[0]
-    dc_shape = scpi.command(b'disp:geom?',True)
+    #all of the queries in one compound message
+    queries = [b'syst:serial?', b'disp:spif?', b'disp:mode?', b'disp:maxc?', b'disp:bri?', b'disp:dotc:all?', b'disp:geom?']
+    (serial,),(spif,),(mode_code,),mc_codes,bc_codes,(dc_bytes,),dc_shape = scpi.batch(queries)
     dc_codes = np.frombuffer(dc_bytes, np.uint8).reshape(dc_shape)
     config.serial = serial
     config.spif = spif
@@ -111,6 +115,12 @@ def download_config(scpi):
     config.maxcurrent = [TLC5955.maxcurrent_mA(mc) for mc in mc_codes]
     config.brightness = [TLC5955.brightness(bc) for bc in bc_codes]
     config.dotcorrect = TLC5955.dotcorrect_img(dc_codes)
+
+def pwm_code(img):
+    """pwm codes for img, through the measured LED responses if there are any"""
+    if config.response is None:
+        return TLC5955.pwm_code(img)
+    return config.response.pwm_code(img)
     
 if mode == 'reset':
     #save defaults to file
@@ -125,9 +135,6 @@ dead_pixels = np.where(np.any(np.isnan(config.dotcorrect),-1).flat)[0]
 
 img = np.zeros((8,12,5))
 
-def img_bytes(img):
-    return scpi.format_bytes(TLC5955.pwm_code(img).tobytes())
-
 if PORTNAME is None:
     print('Detecting Serial ports... ',end='',flush=True)
     target_hwid = 'VID:PID=16C0:04'
@@ -171,7 +178,7 @@ with Serial(PORTNAME) as port:
         # three corners are red, green, blue
         img[[0,0,-1],[0,-1,-1],[0,1,2]] = 0.25
         
-        scpi.command(b'disp:pwm:all ' + img_bytes(img))
+        scpi.write_block(b'disp:pwm:all ', pwm_code(img))
         scpi.command(b'disp on')
         answer = messagebox.askyesno('LED Panel', 'Alignment. Continue?')
         scpi.command(b'disp off')
@@ -180,7 +187,7 @@ with Serial(PORTNAME) as port:
             #cycle through the flatfielded images
             for c in range(5):
                 img[...,c] = 0.25
-                scpi.command(b'disp:pwm:all ' + img_bytes(img))
+                scpi.write_block(b'disp:pwm:all ', pwm_code(img))
                 scpi.command(b'disp on')
                 answer = messagebox.askyesno('LED Panel', 'Continue?')
                 scpi.command(b'disp off')
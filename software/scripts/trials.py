@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+"""
+Precomputed sessions of visual search trials.
+
+Each trial shows a target colour at one pixel and distractors from a palette at
+n_distractors others, chosen at random from the pixels that work. A whole
+session is drawn at once from a seeded np.random.Generator, so it can be made
+again from its design and seed, and is written to disk as a structured .npy
+array, one record per trial holding its pwm codes, ready to send, with the pixels
+and colours it used. The design and seed are saved next to it as JSON.
+
+Sessions are opened memory mapped, so running a trial is a slice and a send:
+
+    session = Session('session.npy')
+    scpi.write_block(b'disp:pwm:all ', session.pwm(i))
+
+Pixels are numbered row-major on the (8,12) panel, as in nemo_testing.py.
+"""
+
+import json
+import numpy as np
+from collections import namedtuple
+from TLC5955 import TLC5955
+from panel_buffers import PANEL_HEIGHT, PANEL_WIDTH, PANEL_DIMS
+
+PIXELS = PANEL_HEIGHT * PANEL_WIDTH
+
+Design = namedtuple('Design', 'targets distractors trials n_distractors dead_pixels target_pixels min_distance background',
+                    defaults=((), None, 0.0, (0.0,)*5))
+Design.__doc__ = """targets : target pwm colours (K,5)
+distractors : distractor palette, pwm colours (P,5)
+trials : number of trials of each target colour
+n_distractors : distractors per trial
+dead_pixels : pixels never used
+target_pixels : pixels the target may be shown at, or None for any
+min_distance : least distance from the target to any distractor, in pixel pitches of the hex grid
+background : pwm colour (5,) of the other pixels"""
+
+def hex_positions():
+    """(x, y) of each pixel (96,2) on the panel's hex grid, as nemo_testing.draw_pattern, neighbours 1 apart"""
+    y, x = np.divmod(np.arange(PIXELS), PANEL_WIDTH)
+    return np.stack([x*np.cos(np.deg2rad(30)), y + 0.5*(x % 2)], -1)
+
+_position = hex_positions()
+_distance = np.linalg.norm(_position[:, None] - _position[None], axis=-1)
+
+def trial_dtype(n_distractors):
+    """record of one trial"""
+    return np.dtype([('target', np.int16), #pixel
+                     ('target_color', np.int16), #index into Design.targets
+                     ('distractors', np.int16, (n_distractors,)), #pixels
+                     ('distractor_colors', np.int16, (n_distractors,)), #indices into Design.distractors
+                     ('pwm', np.uint16, PANEL_DIMS)])
+
+def _random_pick(rng, allowed, n):
+    """n distinct random True columns of each row of allowed (T,96), or ValueError"""
+    if np.any(allowed.sum(-1) < n):
+        raise ValueError(f'not enough pixels to place {n} in every trial')
+    keys = rng.random(allowed.shape)
+    keys[~allowed] = np.inf
+    return np.argsort(keys, -1)[:, :n]
+
+def draw(design, rng):
+    """draw the pixels and colours of every trial: returns records (T,) without pwm"""
+    targets = np.asarray(design.targets, np.float64)
+    n = design.n_distractors
+    valid = np.ones(PIXELS, bool)
+    valid[list(design.dead_pixels)] = False
+    can_target = valid.copy()
+    if design.target_pixels is not None:
+        can_target &= np.isin(np.arange(PIXELS), design.target_pixels)
+
+    colors = np.repeat(np.arange(len(targets)), design.trials)
+    rng.shuffle(colors)
+    trials = np.zeros(len(colors), trial_dtype(n))
+    trials['target_color'] = colors
+    target = _random_pick(rng, np.broadcast_to(can_target, (len(trials), PIXELS)), 1)[:, 0]
+    trials['target'] = target
+    #distractors: valid, and far enough from the target (which also excludes the target itself)
+    allowed = valid & (_distance[target] >= max(design.min_distance, 1e-9))
+    trials['distractors'] = _random_pick(rng, allowed, n)
+    trials['distractor_colors'] = rng.integers(len(design.distractors), size=(len(trials), n))
+    return trials
+
+def render(design, trials, encode=TLC5955.pwm_code, chunk=256):
+    """fill in trials['pwm'], chunk trials at a time
+
+    encode : encode(img, out) pwm fractions to codes, eg. TLC5955.pwm_code or ResponseLUT(...).pwm_code
+    """
+    targets = np.asarray(design.targets, np.float64)
+    palette = np.asarray(design.distractors, np.float64)
+    img = np.empty((min(chunk, len(trials)), PIXELS, PANEL_DIMS[-1]))
+    for start in range(0, len(trials), chunk):
+        t = trials[start:start+chunk]
+        frames = img[:len(t)]
+        frames[...] = design.background
+        rows = np.arange(len(t))[:, None]
+        frames[rows, t['distractors']] = palette[t['distractor_colors']]
+        frames[rows[:, 0], t['target']] = targets[t['target_color']]
+        encode(frames.reshape((len(t),) + PANEL_DIMS), out=t['pwm'])
+
+def _design_json(design, seed):
+    d = {name: np.asarray(value).tolist() if value is not None else None for name, value in design._asdict().items()}
+    return {'design': d, 'seed': seed}
+
+class Session:
+    """a precomputed session, memory mapped"""
+    def __init__(self, path):
+        with open(path + '.json') as f:
+            info = json.load(f)
+        self.design = Design(**info['design'])
+        self.seed = info['seed']
+        self.trials = np.load(path, mmap_mode='r')
+
+    @classmethod
+    def create(cls, path, design, seed, encode=TLC5955.pwm_code):
+        """draw, render and save a session to path (.npy), and the design and seed to path + '.json'"""
+        trials = draw(design, np.random.default_rng(seed))
+        out = np.lib.format.open_memmap(path, 'w+', trials.dtype, trials.shape)
+        out[...] = trials
+        render(design, out, encode)
+        out.flush()
+        del out
+        with open(path + '.json', 'w') as f:
+            json.dump(_design_json(design, seed), f, indent=1)
+        return cls(path)
+
+    def __len__(self):
+        return len(self.trials)
+
+    def __getitem__(self, i):
+        return self.trials[i]
+
+    def pwm(self, i):
+        """pwm codes of trial i (8,12,5), a view of the file, for DISP:PWM:ALL"""
+        return self.trials['pwm'][i]